@@ -4,9 +4,43 @@ import time
 import os
 import argparse
 import pathlib
-from zipfile import ZipFile
-
-from plumbum import local, RETCODE, BG, FG, TEE, CommandNotFound
+import tarfile
+import collections
+import json
+import shutil
+import hashlib
+import inspect
+import io
+import urllib.request
+import urllib.parse
+import urllib.error
+import contextlib
+import platform
+import http.client
+import zlib
+import math
+import gzip
+import subprocess
+import socket
+import socketserver
+import tempfile
+import hmac
+import secrets
+from zipfile import ZipFile, BadZipFile
+
+try:
+    import resource
+except ImportError:
+    # Native Windows Python, CPU and memory usage won't be reported
+    resource = None
+
+try:
+    import fcntl
+except ImportError:
+    # Native Windows Python, builders sharing a download cache have to take care of themselves
+    fcntl = None
+
+from plumbum import local, RETCODE, BG, TEE, CommandNotFound
 
 
 def add_bool_arg(parser, feature, onexplain, name, offexplain, antiname=None, default=False, required=False):
@@ -21,28 +55,105 @@ def add_bool_arg(parser, feature, onexplain, name, offexplain, antiname=None, de
 # Parse args
 parser = argparse.ArgumentParser(description='Build a special edition of FFMPEG.')
 parser.add_argument('--jobs', metavar='j', action="store", dest="jobs", type=int, help='number of parallel jobs')
+parser.add_argument('--load-average', metavar='n', action="store", dest="load_average", type=float,
+                    help='make starts no new jobs while the load average is above this (default: no limit)')
+parser.add_argument('--max-parallel-targets', metavar='n', action="store", dest="max_parallel_targets", type=int,
+                    help='maximum number of targets built simultaneously (default: limited by --jobs only)')
 parser.add_argument('--build', action="store_true", dest="build_mode", help='build solution')
+parser.add_argument('--fetch', action="store_true", dest="fetch_mode",
+                    help='only download and verify archives of selected targets')
+parser.add_argument('--download-cache', metavar='dir', action="store", dest="download_cache",
+                    help='directory with downloaded archives, may be shared between checkouts '
+                         '(default: ~/.cache/ffmpeg-builder/downloads)')
+parser.add_argument('--mirror', metavar='dir|url', action="append", dest="mirrors",
+                    help='directory or HTTP URL with archives, tried before upstream (can be given multiple times, '
+                         'mirrors are tried in order)')
+parser.add_argument('--download-workers', metavar='n', action="store", dest="download_workers", type=int, default=4,
+                    help='number of archives downloaded simultaneously (default: 4)')
+parser.add_argument('--tmpfs', metavar='dir', action="store", dest="tmpfs_dir", nargs="?", const="/dev/shm",
+                    help='extract and build targets in a RAM-backed directory when they fit (default dir: /dev/shm)')
 parser.add_argument('--clean', action="store_true", dest="clean_mode", help='clean solution')
+parser.add_argument('--gc', action="store_true", dest="gc_mode",
+                    help='remove source trees and archives of versions no longer used, then apply --cache-size')
+parser.add_argument('--cache-size', metavar='size', action="store", dest="cache_size",
+                    help='limit for source/build trees in targets/ and downloaded archives, e.g. 20G; '
+                         'least recently used ones are removed after every build')
+parser.add_argument('--plan', action="store_true", dest="plan_mode",
+                    help='show stale targets, build order and estimated duration without building anything')
+parser.add_argument('--benchmark', action="store_true", dest="benchmark_mode",
+                    help='measure encoder throughput of release/bin/ffmpeg')
+parser.add_argument('--benchmark-output', metavar='file', action="store", dest="benchmark_output",
+                    default="benchmark.json", help='where to save benchmark results (default: benchmark.json)')
+parser.add_argument('--benchmark-compare', metavar='file', action="store", dest="benchmark_compare",
+                    help='compare with results of another build, fail on regressions')
+parser.add_argument('--benchmark-threshold', metavar='percent', action="store", dest="benchmark_threshold",
+                    type=float, default=5.0, help='slowdown reported as a regression (default: 5)')
+parser.add_argument('--benchmark-duration', metavar='seconds', action="store", dest="benchmark_duration",
+                    type=int, default=5, help='length of the generated input (default: 5)')
+parser.add_argument('--benchmark-runs', metavar='n', action="store", dest="benchmark_runs",
+                    type=int, default=3, help='runs per encoder preset, the median is reported (default: 3)')
 parser.add_argument('--silent', action="store_true", dest="silent_mode", help='removes most spam')
+parser.add_argument('--log-tail', metavar='n', action="store", dest="log_tail", type=int, default=40,
+                    help='lines of output printed when a command fails, full logs are in targets/logs (default: 40)')
 parser.add_argument('--targets', action="store", dest="targets",
                     help='comma-separated targets for building (empty = build all)')
+parser.add_argument('--profile', action="store", dest="profile", choices=["full", "live-streaming"], default="full",
+                    help='set of ffmpeg components and libraries to build (default: full)')
 parser.add_argument('--exclude-targets', action="store", dest="exclude_targets", help='don\'t build these')
+add_bool_arg(parser, "deps", "also build missing prerequisites of selected targets", "deps",
+             "build only the selected targets", "no-deps",
+             True, False)
+parser.add_argument('--rebuild', action="store", dest="rebuild",
+                    help='comma-separated targets to rebuild together with everything that depends on them')
+parser.add_argument('--rdeps', action="store", dest="rdeps",
+                    help='print targets that depend on these comma-separated targets')
+add_bool_arg(parser, "configure_cache", "share results of autoconf checks between targets (configure --cache-file)",
+             "configure-cache", "run every configure from scratch", "no-configure-cache",
+             False, False)
+add_bool_arg(parser, "prefetch", "download archives in background while building", "prefetch",
+             "download every archive right before building its target", "no-prefetch",
+             True, False)
+parser.add_argument('--artifact-cache', metavar='dir|url', action="store", dest="artifact_cache",
+                    help='directory or plain HTTP URL with prebuilt target artifacts (GET to restore, PUT to upload)')
+add_bool_arg(parser, "artifact_upload", "upload artifacts of freshly built targets", "artifact-upload",
+             "only restore artifacts, never upload", "no-artifact-upload",
+             True, False)
+parser.add_argument('--compiler-cache', action="store", dest="compiler_cache", choices=["ccache", "sccache"],
+                    help='run every compiler through ccache or sccache')
+parser.add_argument('--compiler-cache-dir', metavar='dir', action="store", dest="compiler_cache_dir",
+                    help='compiler cache directory (default: the one configured for ccache/sccache)')
+parser.add_argument('--compiler-cache-size', metavar='size', action="store", dest="compiler_cache_size",
+                    help='maximum compiler cache size, e.g. 20G')
+parser.add_argument('--time-trace', metavar='targets', action="store", dest="time_trace",
+                    help='build these comma-separated targets with clang -ftime-trace and report compile hotspots, '
+                         'e.g. x265,av1,ffmpeg')
+add_bool_arg(parser, "optimized_mode", "build ffmpeg, x264 and x265 with ThinLTO and profile-guided optimization",
+             "optimized", "build with default optimization", "no-optimized",
+             False, False)
+parser.add_argument('--workers', metavar='addresses', action="store", dest="workers",
+                    help='comma-separated build workers, tcp://host:port or ssh://[user@]host/path/to/checkout; '
+                         'independent targets are built there and ffmpeg is linked here')
+parser.add_argument('--worker', action="store_true", dest="worker_mode",
+                    help='serve one coordinator on stdin/stdout (used by ssh:// workers)')
+parser.add_argument('--worker-listen', metavar='[host:]port', action="store", dest="worker_listen",
+                    help='serve coordinators over TCP, on 127.0.0.1 unless a host is given; '
+                         'other hosts need --worker-token-file')
+parser.add_argument('--worker-token-file', metavar='file', action="store", dest="worker_token_file",
+                    help='shared secret of TCP workers and their coordinators '
+                         '(or FFMPEG_BUILDER_WORKER_TOKEN in the environment)')
 add_bool_arg(parser, "slavery_mode", "use non-free components", "slavery",
              "use free components", "freedom",
              True, False)
+parser.add_argument('--matrix', metavar='variants', action="store", dest="matrix",
+                    help='build several variants one after another, comma-separated freedom|slavery[/profile], '
+                         'e.g. freedom,slavery,slavery/live-streaming')
+# Set by --matrix for every variant it runs
+parser.add_argument('--variant', action="store", dest="variant", help=argparse.SUPPRESS)
 
 args = parser.parse_args()
 
-# Set up targets
-TARGETS_DEFAULT = ["yasm", "nasm", "opencore", "libvpx", "lame", "opus", "xvidcore", "x264", "libogg",
-                   "libvorbis", "libtheora", "pkg-config", "cmake", "vid_stab", "x265", "fdk_aac", "av1",
-                   "zlib", "openssl", "sdl", "ffmpeg", "ffmpeg-msys2-deps"]
-TARGETS = TARGETS_DEFAULT
-if args.targets is not None:
-    TARGETS = args.targets.split(",")
-if args.exclude_targets is not None:
-    EXCLUDE_TARGETS = args.exclude_targets.split(",")
-    TARGETS = [x for x in TARGETS if x not in EXCLUDE_TARGETS]
+# Set up targets, see select_targets()
+TARGETS = []
 
 # Aliases
 fex = os.path.exists
@@ -52,10 +163,23 @@ SHELL = 'bash'
 
 # Set up output directories
 CWD = local.cwd
-TARGET_DIR = pj(CWD, "targets")
-RELEASE_DIR = pj(CWD, "release")
+MATRIX_DIR = pj(CWD, "matrix")
+WORKER_DIR = pj(CWD, "worker")
+if args.variant is not None:
+    TARGET_DIR = pj(MATRIX_DIR, args.variant, "targets")
+    RELEASE_DIR = pj(MATRIX_DIR, args.variant, "release")
+elif args.worker_mode or args.worker_listen is not None:
+    # A worker wipes its release for every request, so it must not touch the one of the checkout
+    TARGET_DIR = pj(WORKER_DIR, "targets")
+    RELEASE_DIR = pj(WORKER_DIR, "release")
+else:
+    TARGET_DIR = pj(CWD, "targets")
+    RELEASE_DIR = pj(CWD, "release")
 RELEASE_BIN_DIR = pj(RELEASE_DIR, "bin")
 PKG_CONFIG_PATH = pj(RELEASE_DIR, "lib", "pkgconfig")
+# Archives don't depend on the checkout, so they are kept outside of it and survive --clean
+DOWNLOAD_CACHE_DIR = args.download_cache if args.download_cache is not None else \
+    pj(os.path.expanduser("~"), ".cache", "ffmpeg-builder", "downloads")
 
 # Set up C/C++ compiler
 CC = local["clang"]
@@ -70,11 +194,15 @@ OS_TYPE_LINUX = "Linux"
 OS_TYPE_MAC = "Darwin"
 OS_TYPE_WINDOWS = "Windows"
 # mad skills: https://stackoverflow.com/questions/1325581/how-do-i-check-if-im-running-on-windows-in-python
-OS_TYPE = OS_TYPE_WINDOWS if hasattr(sys, 'getwindowsversion') else local['uname']()
+OS_TYPE = OS_TYPE_WINDOWS if hasattr(sys, 'getwindowsversion') else platform.system()
 
 # Set up constants
 DOWNLOAD_RETRY_DELAY = 3
 DOWNLOAD_RETRY_ATTEMPTS = 3
+DOWNLOAD_TIMEOUT = 60
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Some mirrors (hello, SourceForge) serve an HTML page instead of a redirect to anything that looks like a browser
+DOWNLOAD_USER_AGENT = "curl/7.68.0"
 
 ARCHIVE_FORMAT_TAR = "TAR"
 ARCHIVE_FORMAT_ZIP = "ZIP"
@@ -161,25 +289,66 @@ def fail():
 
 # Please note that neat features of Plumbum like FG, BG and TEE are not working on Windows.
 # Especially TEE that runs `select` against new processes.
-# Therefore, now we have no meaningful debug output whatsoever.
-# It's a huge problem, but I know no quick fixes, and Windows is too important now.
 # https://github.com/tomerfiliba/plumbum/issues/170
 #
-# A temporary solution:
-# Plumbum provides enough information for a very basic log-driven debugging though.
-# For a deep understanding of underlying errors you have to hack this script by yourself to add some reporting.
+# So fg() reads merged stdout and stderr of a plain popen line by line, which needs no `select`.
+# Every line goes to a compressed log of the current target (targets/logs/<target>.log.gz),
+# is echoed with a [target] prefix unless --silent, and lands in a small ring buffer.
+# Nothing else is kept in memory, even for the noisiest make of ffmpeg. When the command fails,
+# the ring buffer is printed, so the error is visible even in silent mode.
+LOGS_DIR = pj(TARGET_DIR, "logs")
+TARGET_LOG = None
+
+
+def log_file_name(target):
+    return pj(LOGS_DIR, f"{target}.log.gz")
+
+
+def open_target_log(target):
+    global TARGET_LOG
+    mkdir(LOGS_DIR)
+    TARGET_LOG = gzip.open(log_file_name(target), "wt", encoding="utf-8")
+
+
+def close_target_log():
+    global TARGET_LOG
+    if TARGET_LOG is not None:
+        TARGET_LOG.close()
+        TARGET_LOG = None
+
 
-def fg(a, *cmds):
+def fg(a, *cmds, pass_fds=()):
+    tail = collections.deque(maxlen=args.log_tail)
+    prefix = f"[{CURRENT_TARGET}] " if CURRENT_TARGET is not None else ""
     try:
-        if args.silent_mode:
-            (local[a][cmds])()
-        else:
-            local[a][cmds] & FG
-        return True
+        command = local[a][cmds]
+        if TARGET_LOG is not None:
+            TARGET_LOG.write(f"$ {command}\n")
+        p = command.popen(stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                          **({"pass_fds": pass_fds} if pass_fds else {}))
+        for raw_line in iter(p.stdout.readline, b""):
+            line = raw_line.decode("utf-8", errors="replace").rstrip("\r\n")
+            tail.append(line)
+            if TARGET_LOG is not None:
+                TARGET_LOG.write(line + "\n")
+            if not args.silent_mode:
+                print(prefix + line, flush=True)
+        p.stdout.close()
+        retcode = p.wait()
     except Exception as e:
         print(f"Failed to execute in foreground")
         print(e)
         return False
+    if retcode != 0:
+        print_header(f"{prefix}Failed to execute in foreground, exit code {retcode}: {command}",
+                     f"Last {len(tail)} lines of output:" if tail else "No output")
+        if tail:
+            print_lines(*(prefix + line for line in tail))
+        if TARGET_LOG is not None:
+            TARGET_LOG.flush()
+            print(f"{prefix}Full log: {TARGET_LOG.name}")
+        return False
+    return True
 
 
 def sfg(a, *cmds):
@@ -247,7 +416,7 @@ def rmdir(dir_name):
     if not os.path.exists(dir_name):
         print(f"Directory {dir_name} doesn't exist, no need to remove it")
     else:
-        os.rmdir(dir_name)
+        shutil.rmtree(dir_name, ignore_errors=True)
         if not fex(dir_name):
             print(f"Directory {dir_name} removed successfully")
         else:
@@ -266,57 +435,597 @@ def rm(*file_name_parts):
             print(f"File {file_name} still exists, can't remove")
 
 
-def curl(src, dest):
-    # It's a miracle, but crul on MSYS2 use plain paths instead of shielding it with cpp(dest).
-    # Trying to shield it will raise an error
-    return fg("curl", "-L", "--silent", "-o", dest, src)
+# Instrumentation
+# Every step of a target (download, extract, patch, configure, make, install) is timed with wall time,
+# CPU time of the builder and its children, and peak RSS of child processes. Each target process saves its
+# records to targets/reports, and the main process merges them into a JSON report and a Chrome trace.
+REPORTS_DIR = pj(TARGET_DIR, "reports")
+BUILD_REPORT_FILE = pj(REPORTS_DIR, "build-report.json")
+BUILD_TRACE_FILE = pj(REPORTS_DIR, "build-trace.json")
+# Build times of recent runs, per host, for --plan estimates. Reports are reset on every build, so it lives outside.
+BUILD_HISTORY_FILE = pj(TARGET_DIR, "build-history.json")
+BUILD_HISTORY_LENGTH = 5
+PHASE_RECORDS = []
 
 
-def untar(src, dest):
-    return sfg("tar", "-xvf", cpp(src), "-C", cpp(dest))
+def cpu_seconds(usage):
+    return usage.ru_utime + usage.ru_stime
 
 
-def download(url, dest_name, alter_name=None, archive_format=ARCHIVE_FORMAT_TAR):
-    download_path = TARGET_DIR
-
-    if alter_name is not None:
-        download_path = pj(TARGET_DIR, alter_name)
-        mkdir(download_path)
+def rss_kb(usage):
+    # Linux reports kilobytes, MacOS reports bytes
+    return usage.ru_maxrss // 1024 if OS_TYPE == OS_TYPE_MAC else usage.ru_maxrss
 
-    base_path = pj(download_path, dest_name)
-    if not fex(base_path):
-        print(f"Downloading {url}")
 
-        successful_download = False
-        for x in range(DOWNLOAD_RETRY_ATTEMPTS):
-            if curl(url, base_path) is not True:
-                print(f"Downloading failed: {url}. Retrying in {DOWNLOAD_RETRY_DELAY} seconds")
-                time.sleep(DOWNLOAD_RETRY_DELAY)
-            else:
-                successful_download = True
+@contextlib.contextmanager
+def phase(name, target=None):
+    target = target if target is not None else CURRENT_TARGET
+    started = time.time()
+    self_before = resource.getrusage(resource.RUSAGE_SELF) if resource else None
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN) if resource else None
+    succeeded = False
+    try:
+        yield
+        succeeded = True
+    finally:
+        record = {"target": target, "phase": name, "start": started, "wall": time.time() - started,
+                  "pid": os.getpid(), "ok": succeeded}
+        if resource is not None:
+            self_after = resource.getrusage(resource.RUSAGE_SELF)
+            children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            record["cpu_self"] = cpu_seconds(self_after) - cpu_seconds(self_before)
+            record["cpu_children"] = cpu_seconds(children_after) - cpu_seconds(children_before)
+            # ru_maxrss of children is the peak of the largest child waited for so far, not just in this phase.
+            # With fork every target is built in its own process, so the largest value of a target is its own peak
+            record["max_child_rss_so_far_kb"] = rss_kb(children_after)
+        PHASE_RECORDS.append(record)
+
+
+def save_phase_records(file_name):
+    mkdir(REPORTS_DIR)
+    with open(pj(REPORTS_DIR, file_name), "w") as f:
+        json.dump(PHASE_RECORDS, f, indent=2)
+    PHASE_RECORDS.clear()
+
+
+def reset_reports():
+    if fex(REPORTS_DIR):
+        for name in os.listdir(REPORTS_DIR):
+            if name.endswith(".json"):
+                os.remove(pj(REPORTS_DIR, name))
+
+
+def load_phase_records():
+    records = []
+    if not fex(REPORTS_DIR):
+        return records
+    for name in sorted(os.listdir(REPORTS_DIR)):
+        path = pj(REPORTS_DIR, name)
+        if not name.endswith(".phases.json"):
+            continue
+        with open(path) as f:
+            records.extend(json.load(f))
+    return records
+
+
+def read_build_history():
+    try:
+        with open(BUILD_HISTORY_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def record_build_history(targets):
+    history = read_build_history()
+    host_history = history.setdefault(platform.node(), {})
+    for name, summary in targets.items():
+        # Restored and cached targets say nothing about how long a build takes
+        if "make" not in summary["phases"]:
+            continue
+        runs = host_history.setdefault(name, [])
+        run = {"wall": round(summary["wall"] - summary["phases"].get("download", 0.0), 1),
+               "date": time.strftime("%Y-%m-%dT%H:%M:%S")}
+        try:
+            with open(pj(REPORTS_DIR, f"{name}.tree.json")) as f:
+                run.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+        runs.append(run)
+        del runs[:-BUILD_HISTORY_LENGTH]
+    with open(BUILD_HISTORY_FILE, "w") as f:
+        json.dump(history, f, indent=2)
+
+
+def write_build_report():
+    records = load_phase_records()
+    if not records:
+        return
+    targets = {}
+    for record in records:
+        summary = targets.setdefault(record["target"], {"wall": 0.0, "cpu": 0.0, "max_child_rss_so_far_kb": 0,
+                                                        "phases": {}})
+        summary["wall"] += record["wall"]
+        summary["cpu"] += record.get("cpu_self", 0.0) + record.get("cpu_children", 0.0)
+        summary["max_child_rss_so_far_kb"] = max(summary["max_child_rss_so_far_kb"],
+                                                 record.get("max_child_rss_so_far_kb", 0))
+        summary["phases"][record["phase"]] = summary["phases"].get(record["phase"], 0.0) + record["wall"]
+    started = min(x["start"] for x in records)
+    finished = max(x["start"] + x["wall"] for x in records)
+    with open(BUILD_REPORT_FILE, "w") as f:
+        json.dump({"os": OS_TYPE, "jobs": JOBS, "started": started, "wall": finished - started,
+                   "targets": targets, "phases": records}, f, indent=2)
+
+    # Chrome trace event format, opens in Perfetto or chrome://tracing. Every target gets its own lane.
+    lanes = {name: index + 1 for index, name in enumerate(targets)}
+    events = [{"name": "thread_name", "ph": "M", "pid": 1, "tid": lane, "args": {"name": name}}
+              for name, lane in lanes.items()]
+    for record in records:
+        events.append({"name": record["phase"], "cat": record["target"], "ph": "X", "pid": 1,
+                       "tid": lanes[record["target"]],
+                       "ts": int((record["start"] - started) * 1000000), "dur": int(record["wall"] * 1000000),
+                       "args": {k: v for k, v in record.items() if k not in ("start", "wall", "phase")}})
+    with open(BUILD_TRACE_FILE, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    record_build_history(targets)
+
+    print_header("Time spent per target (wall seconds, slowest phase):")
+    for name, summary in sorted(targets.items(), key=lambda x: -x[1]["wall"]):
+        slowest = max(summary["phases"].items(), key=lambda x: x[1])
+        print(f"{name:>20}: {summary['wall']:8.1f}s, cpu {summary['cpu']:8.1f}s, "
+              f"{slowest[0]} {slowest[1]:.1f}s, max child rss so far {summary['max_child_rss_so_far_kb'] // 1024} MB")
+    print_block(f"Report: {BUILD_REPORT_FILE}", f"Chrome trace: {BUILD_TRACE_FILE}")
+
+
+Source = collections.namedtuple("Source", ["url", "dest_name", "alter_name", "archive_format", "sha256"],
+                                defaults=(None, ARCHIVE_FORMAT_TAR, None))
+
+
+def download_dir(alter_name=None):
+    if alter_name is None:
+        return WORK_DIR
+    return pj(WORK_DIR, alter_name)
+
+
+def archive_path(source):
+    # Different URLs may have the same archive name ("master.zip"), so names in the shared cache get a URL hash
+    url_hash = hashlib.sha256(source.url.encode()).hexdigest()[:16]
+    return pj(DOWNLOAD_CACHE_DIR, f"{url_hash}-{source.dest_name}")
+
+
+def source_urls(source):
+    # Mirrors have the same layout as the download cache (so a cache can be served as is), or plain archive names
+    names = (os.path.basename(archive_path(source)), source.dest_name)
+    urls = []
+    for mirror in args.mirrors or ():
+        if is_http_url(mirror):
+            urls += [f"{mirror.rstrip('/')}/{urllib.parse.quote(name)}" for name in names]
+            continue
+        for name in names:
+            if fex(pj(mirror, name)):
+                urls.append(pathlib.Path(os.path.abspath(pj(mirror, name))).as_uri())
                 break
+    return urls + [source.url]
+
+
+@contextlib.contextmanager
+def file_lock(base_path):
+    # Several builders (or prefetch processes) may want the same archive from a shared cache,
+    # and parallel targets update the same configure cache
+    if fcntl is None:
+        yield
+        return
+    with open(f"{base_path}.lock", "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def checksum_file_name(base_path):
+    return f"{base_path}.sha256"
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def verify_checksum(base_path, expected, actual):
+    # Archives without a pinned checksum are trusted on first use: the hash is remembered next to the archive,
+    # so at least every later download of the same URL has to match it
+    if expected is None and fex(checksum_file_name(base_path)):
+        with open(checksum_file_name(base_path)) as f:
+            expected = f.read().strip()
+    if expected is None:
+        print(f"No pinned SHA-256 for {os.path.basename(base_path)}, remembering sha256={actual}")
+        with open(checksum_file_name(base_path), "w") as f:
+            f.write(actual)
+        return True
+    if expected != actual:
+        print(f"SHA-256 mismatch for {os.path.basename(base_path)}: expected {expected}, got {actual}")
+        return False
+    # Pinned hashes are remembered as well, that's how extraction stamps know which archive they belong to
+    with open(checksum_file_name(base_path), "w") as f:
+        f.write(actual)
+    return True
+
+
+def archive_sha256(base_path):
+    if not fex(checksum_file_name(base_path)):
+        # Downloaded before pinned hashes were remembered
+        with open(checksum_file_name(base_path), "w") as f:
+            f.write(file_sha256(base_path))
+    with open(checksum_file_name(base_path)) as f:
+        return f.read().strip()
+
+
+# Extraction stamps
+# Unpacking ffmpeg, cmake or aom is thousands of file writes, so every extracted source tree gets a stamp with
+# the hash of its archive and the list of its files. While the archive is the same and every file is still there,
+# the tree is used as it is. Files changed by patches and builds are fine, patches are applied again anyway.
+def extraction_stamp_file_name(source):
+    return pj(download_dir(source.alter_name), f"{source.dest_name}.extracted")
 
-        if not successful_download:
-            print(f"Failed to download multiple times: {url}")
-            fail()
-        else:
-            print(f"Successfuly downloaded: {url}")
-    else:
-        print(f"Used from local cache: {url}")
 
+def write_extraction_stamp(source, sha256, files):
+    with open(extraction_stamp_file_name(source), "w") as f:
+        json.dump({"sha256": sha256, "files": files}, f)
+
+
+def extraction_intact(source, sha256):
+    try:
+        with open(extraction_stamp_file_name(source)) as f:
+            stamp = json.load(f)
+    except (OSError, ValueError):
+        return False
+    root = download_dir(source.alter_name)
+    return stamp.get("sha256") == sha256 and all(os.path.lexists(pj(root, x)) for x in stamp["files"])
+
+
+def extract_archive(base_path, archive_format, dest):
     if archive_format == ARCHIVE_FORMAT_TAR:
-        if not untar(base_path, download_path):
-            print(f"Failed to extract {dest_name}")
-            fail()
+        with tarfile.open(base_path, mode="r|*") as archive:
+            return extract_tar_stream(archive, dest)
     elif archive_format == ARCHIVE_FORMAT_ZIP:
         with ZipFile(base_path) as myzip:
-            myzip.extractall(download_path)
+            myzip.extractall(dest)
+            return myzip.namelist()
     else:
         raise Exception
 
 
-def build_lock_file_name(target):
-    return pj(TARGET_DIR, f"{target}.ok")
+class DownloadTee:
+    # Everything read from the network is written to the archive copy and hashed on the fly,
+    # so the tarball is hashed, extracted and saved for the cache in a single pass.
+    # A resumed download replays the bytes it already has first, so they are hashed and extracted too.
+    def __init__(self, response, copy_file, resumed_file=None, resumed_size=0):
+        self.response = response
+        self.copy_file = copy_file
+        self.resumed_file = resumed_file
+        self.resumed_left = resumed_size
+        self.sha256 = hashlib.sha256()
+        self.size = resumed_size
+
+    def read(self, size=-1):
+        if self.resumed_left > 0:
+            data = self.resumed_file.read(self.resumed_left if size is None or size < 0 else
+                                          min(size, self.resumed_left))
+            self.resumed_left -= len(data)
+            self.sha256.update(data)
+            return data
+        data = self.response.read(size) if size is not None and size >= 0 else self.response.read()
+        self.copy_file.write(data)
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+    def drain(self):
+        while self.read(DOWNLOAD_CHUNK_SIZE):
+            pass
+
+
+def extract_tar_stream(archive, dest):
+    if hasattr(tarfile, "tar_filter"):
+        archive.extractall(dest, filter="tar")
+    else:
+        archive.extractall(dest)
+    return [x.name for x in archive.getmembers()]
+
+
+def remove_extracted_files(dest, files):
+    # Reverse order puts the contents of a directory before the directory itself,
+    # and directories that had something else in them are left alone
+    for name in sorted(files, reverse=True):
+        path = pj(dest, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
+        elif os.path.lexists(path):
+            os.remove(path)
+
+
+def stream_fetch(url, part_path, archive_format, extract_path=None, extracted_files=None):
+    # A partial file left by a broken connection is continued with a Range request
+    offset = os.path.getsize(part_path) if fex(part_path) else 0
+    headers = {"User-Agent": DOWNLOAD_USER_AGENT}
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+    request = urllib.request.Request(url, headers=headers)
+    tee = None
+    expected_size = None
+    try:
+        with urllib.request.urlopen(request, timeout=DOWNLOAD_TIMEOUT) as response:
+            if offset and getattr(response, "status", None) != 206:
+                # The server (or a local mirror) ignored the range and sends everything again
+                offset = 0
+            if offset:
+                print(f"Resuming {url} from {offset} bytes")
+            if response.headers.get("Content-Length") is not None:
+                expected_size = offset + int(response.headers["Content-Length"])
+            with open(part_path, "ab" if offset else "wb") as f, open(part_path, "rb") as resumed_file:
+                tee = DownloadTee(response, f, resumed_file, offset)
+                if archive_format == ARCHIVE_FORMAT_TAR:
+                    # Even without extraction the stream is parsed, which catches truncated archives
+                    # that were served without Content-Length
+                    with tarfile.open(fileobj=tee, mode="r|*") as archive:
+                        if extract_path is not None:
+                            extracted_files[:] = extract_tar_stream(archive, extract_path)
+                        else:
+                            for _ in archive:
+                                pass
+                tee.drain()
+        if archive_format == ARCHIVE_FORMAT_ZIP:
+            # Zip keeps its index at the end, so it can't be streamed, but opening it checks the index
+            with ZipFile(part_path):
+                pass
+    except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+        # Network trouble, whatever was received is kept for the next attempt
+        print(f"Downloading failed: {url}: {e}")
+        if isinstance(e, urllib.error.HTTPError) and e.code == 416 and fex(part_path):
+            # Range Not Satisfiable: the partial file is not a prefix of this archive
+            os.remove(part_path)
+        return None
+    except (EOFError, zlib.error, tarfile.TarError, BadZipFile) as e:
+        if tee is not None and expected_size is not None and tee.size < expected_size:
+            # The connection was closed early, so the archive just ends too soon. The rest can still come.
+            print(f"Downloading interrupted: {url}: {tee.size} of {expected_size} bytes received")
+            return None
+        print(f"Downloaded archive is broken: {url}: {e}")
+        if fex(part_path):
+            os.remove(part_path)
+        return None
+    return tee.sha256.hexdigest()
+
+
+def fetch(urls, base_path, archive_format=ARCHIVE_FORMAT_TAR, sha256=None, extract_path=None, extracted_files=None):
+    # Downloads go to a temporary file first, so an interrupted download is never mistaken for a cached one
+    part_path = f"{base_path}.part"
+    for x in range(DOWNLOAD_RETRY_ATTEMPTS):
+        for url in urls:
+            print(f"Downloading {url}")
+            digest = stream_fetch(url, part_path, archive_format, extract_path, extracted_files)
+            if digest is None:
+                continue
+            if verify_checksum(base_path, sha256, digest):
+                os.replace(part_path, base_path)
+                print(f"Successfuly downloaded: {url}")
+                return True
+            # Downloading a different archive again won't make it the right one
+            os.remove(part_path)
+            if extracted_files:
+                remove_extracted_files(extract_path, extracted_files)
+                extracted_files.clear()
+            return False
+        print(f"Downloading failed: {urls[-1]}. Retrying in {DOWNLOAD_RETRY_DELAY} seconds")
+        time.sleep(DOWNLOAD_RETRY_DELAY)
+
+    print(f"Failed to download multiple times: {urls[-1]}")
+    return False
+
+
+def download(source):
+    download_path = download_dir(source.alter_name)
+
+    if source.alter_name is not None:
+        mkdir(download_path)
+
+    base_path = archive_path(source)
+    extracted_files = []
+    with file_lock(base_path):
+        if not fex(base_path):
+            with phase("download"):
+                if not fetch(source_urls(source), base_path, source.archive_format, source.sha256,
+                             extract_path=download_path, extracted_files=extracted_files):
+                    fail()
+        else:
+            print(f"Used from local cache: {source.url}")
+            touch_cache_entry(base_path)
+    sha256 = archive_sha256(base_path)
+
+    if extracted_files:
+        # Tarballs are extracted while downloading
+        write_extraction_stamp(source, sha256, extracted_files)
+        return
+    if extraction_intact(source, sha256):
+        print(f"Already extracted: {source.dest_name}")
+        return
+    with phase("extract"):
+        try:
+            extracted_files = extract_archive(base_path, source.archive_format, download_path)
+        except (OSError, EOFError, zlib.error, tarfile.TarError, BadZipFile) as e:
+            print(f"Failed to extract {source.dest_name}: {e}")
+            fail()
+    write_extraction_stamp(source, sha256, extracted_files)
+
+
+def download_source(target):
+    download(TARGET_REGISTRY[target].source)
+
+
+def need_fetching(target):
+    source = TARGET_REGISTRY[target].source
+    return source is not None and not fex(archive_path(source)) and \
+        (target in FORCED_TARGETS or not artifact_available(target))
+
+
+def prefetch_target(target, extract=True):
+    # Tarballs are extracted into the target tree while downloading, the build then finds them already there
+    source = TARGET_REGISTRY[target].source
+    if source.alter_name is not None:
+        mkdir(download_dir(source.alter_name))
+    extracted_files = []
+    try:
+        with phase("download", target), file_lock(archive_path(source)):
+            if not fex(archive_path(source)) and \
+                    not fetch(source_urls(source), archive_path(source), source.archive_format, source.sha256,
+                              extract_path=download_dir(source.alter_name) if extract else None,
+                              extracted_files=extracted_files):
+                fail()
+        if extracted_files:
+            write_extraction_stamp(source, archive_sha256(archive_path(source)), extracted_files)
+    finally:
+        save_phase_records(f"{target}.download.phases.json")
+
+
+# Build cache
+# Every target has a cache key: a hash of everything that goes into its build (source, options, recipe,
+# toolchain, environment) and of the keys of its dependencies. A target is rebuilt only when its key changes,
+# and since keys include dependency keys, everything downstream of a changed target is rebuilt as well.
+TOOLCHAIN_COMMANDS = ("clang", "clang++", "cc", "c++", "gcc", "g++")
+TOOLCHAIN_ENV_VARS = ("CC", "CXX", "CFLAGS", "CXXFLAGS", "CPPFLAGS", "LDFLAGS", "PKG_CONFIG_PATH")
+TARGET_KEYS = {}
+TARGET_INPUTS = {}
+
+
+def build_stamp_file_name(target):
+    return pj(TARGET_DIR, f"{target}.stamp")
+
+
+def read_build_stamp(target):
+    try:
+        with open(build_stamp_file_name(target)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def file_identity(path):
+    # Size and mtime are good enough to notice an upgraded compiler, and we don't need to spawn it to find out
+    stat = os.stat(path)
+    return f"{path}:{stat.st_size}:{int(stat.st_mtime)}"
+
+
+def find_real_command(cmd):
+    # Compiler cache wrappers don't change the output, so they must not change cache keys either
+    search_path = os.pathsep.join(x for x in local.env["PATH"].split(os.pathsep) if x != COMPILER_CACHE_BIN_DIR)
+    return shutil.which(cmd, path=search_path)
+
+
+def toolchain_identity():
+    result = {}
+    for cmd in TOOLCHAIN_COMMANDS:
+        path = find_real_command(cmd)
+        result[cmd] = file_identity(os.path.realpath(path)) if path is not None else None
+    return result
+
+
+def recipe_hash(target):
+    t = TARGET_REGISTRY[target]
+    # Declared targets share one recipe, so their description is hashed together with it
+    parts = [inspect.getsource(t.recipe if t.recipe is not None else build_declared),
+             repr((t.build_system, t.source_dir, t.build_dir, t.patches))]
+    parts += [inspect.getsource(x) for x in (t.env, t.post_install) if callable(x)]
+    parts += [inspect.getsource(x) if callable(x) else repr(x) for x in t.recipe_helpers]
+    return hashlib.sha256(os.linesep.join(parts).encode()).hexdigest()
+
+
+def build_inputs(target, dep_keys, toolchain):
+    t = TARGET_REGISTRY[target]
+    inputs = {
+        "source": t.source.url if t.source is not None else None,
+        "options": list(target_options(target)),
+        "recipe": recipe_hash(target),
+        "toolchain": toolchain,
+        "environment": {var: local.env.get(var) for var in TOOLCHAIN_ENV_VARS},
+        "flags": {"CC": str(CC), "CFLAGS": CFLAGS, "LDFLAGS": LDFLAGS},
+        "os": OS_TYPE,
+        "deps": dep_keys,
+    }
+    if t.patch_queue is not None:
+        inputs["patch_queue"] = patch_series(target)
+    if time_traced(target):
+        # Compilers and flags are set from the environment, which isn't in the options
+        inputs["time_trace"] = True
+    if optimized(target):
+        # The profile is referenced by path in the options, so its content has to be hashed separately
+        inputs["optimization"] = {"stage": PGO_STAGE,
+                                  "profile": PGO_PROFILE_SHA256 if PGO_STAGE == PGO_STAGE_USE else None}
+    return inputs
+
+
+def cache_key(inputs, relocatable=True):
+    # Build directories are replaced with placeholders, so the same build in another checkout (or on another host)
+    # gets the same key, and its artifact can be reused after relocation. Targets with the prefix compiled into
+    # their binaries can't be relocated, their keys keep the real directories (and so do keys of everything
+    # built on top of them).
+    dump = json.dumps(inputs, sort_keys=True)
+    if not relocatable:
+        return hashlib.sha256(dump.encode()).hexdigest()
+    for path, placeholder in ((cpp(RELEASE_DIR), "@PREFIX@"), (RELEASE_DIR, "@PREFIX@"),
+                              (cpp(TARGET_DIR), "@TARGETS@"), (TARGET_DIR, "@TARGETS@")):
+        dump = dump.replace(path, placeholder)
+    return hashlib.sha256(dump.encode()).hexdigest()
+
+
+def reset_cache_keys():
+    TARGET_KEYS.clear()
+    TARGET_INPUTS.clear()
+
+
+def compute_cache_keys():
+    toolchain = toolchain_identity()
+
+    def compute(target):
+        if target in TARGET_KEYS:
+            return TARGET_KEYS[target]
+        dep_keys = {}
+        for dep in TARGET_REGISTRY[target].deps:
+            if not TARGET_REGISTRY[dep].supported():
+                continue
+            stamp = read_build_stamp(dep)
+            if dep not in TARGETS and stamp is not None:
+                # Not going to be rebuilt now, so whatever is installed is what we build against
+                dep_keys[dep] = stamp["key"]
+            else:
+                dep_keys[dep] = compute(dep)
+        TARGET_INPUTS[target] = build_inputs(target, dep_keys, toolchain)
+        TARGET_KEYS[target] = cache_key(TARGET_INPUTS[target], TARGET_REGISTRY[target].relocatable)
+        return TARGET_KEYS[target]
+
+    for name, t in TARGET_REGISTRY.items():
+        if t.supported():
+            compute(name)
+
+
+def stale_inputs(target):
+    stamp = read_build_stamp(target)
+    if stamp is None:
+        return None
+    if stamp["key"] == TARGET_KEYS[target]:
+        return []
+    old_inputs = stamp.get("inputs", {})
+    new_inputs = TARGET_INPUTS[target]
+    changed = [x for x in new_inputs if x != "deps" and old_inputs.get(x) != new_inputs[x]]
+    old_deps = old_inputs.get("deps", {})
+    changed += [dep for dep, key in new_inputs["deps"].items() if old_deps.get(dep) != key]
+    return changed if changed else ["key"]
 
 
 def need_building(target):
@@ -326,18 +1035,348 @@ def need_building(target):
     print("")
     print(f"Building target: {target}")
     print(italic_separator)
-    if fex(build_lock_file_name(target)):
+    if target in FORCED_TARGETS:
+        print("Rebuild requested")
+        return True
+    changed = stale_inputs(target)
+    if changed is None:
+        print("No cache, needs building")
+        return True
+    elif not changed:
         print_block("Cached version found")
         return False
     else:
-        print("No cache, needs building")
+        print(f"Cached version is stale ({', '.join(changed)} changed), needs building")
         return True
 
 
+def write_build_stamp(target):
+    filename = build_stamp_file_name(target)
+    print_block(f"Creating a build stamp: {filename}")
+    with open(filename, "w") as f:
+        json.dump({"key": TARGET_KEYS[target], "inputs": TARGET_INPUTS[target]}, f, indent=2, sort_keys=True)
+
+
 def mark_as_built(target):
-    filename = build_lock_file_name(target)
-    print_block(f"Creating a lock file: {filename}")
-    return local["touch"][filename] & FG
+    with phase("publish"):
+        publish_stage(target)
+    if args.artifact_cache is not None and args.artifact_upload:
+        with phase("export"):
+            export_artifact(target)
+    write_build_stamp(target)
+
+
+# Staged installs and prebuilt artifacts
+# Every target is installed with DESTDIR into its own stage directory, and then hardlinked into RELEASE_DIR.
+# The stage is exactly the set of files the target installs, so it can be packed as an artifact keyed
+# by the target's cache key, and a later build (here or on another host) can unpack it instead of building.
+# A published stage has a manifest with its key and files. When a target is rebuilt, its previous stage is kept
+# as <target>@<key>, files the new version doesn't install anymore are unlinked from the release, and if
+# the build fails the previous stage is put back. Going back to a kept version is just a relink.
+STAGE_DIR = pj(TARGET_DIR, "stage")
+STAGE_MANIFEST_FILE = "manifest.json"
+STAGE_VERSIONS_KEPT = 2
+CURRENT_TARGET = None
+
+
+def stage_dir(target):
+    return pj(STAGE_DIR, target)
+
+
+def staged_prefix(target):
+    root = stage_dir(target)
+    candidates = [root + cpp(RELEASE_DIR)]
+    if OS_TYPE == OS_TYPE_WINDOWS:
+        # CMake drops the drive letter when it joins DESTDIR with a native Windows prefix
+        candidates.append(root + re.sub("^/[a-z]/", "/", cpp(RELEASE_DIR)))
+    for candidate in candidates:
+        if fex(candidate):
+            return candidate
+    return candidates[0]
+
+
+def staged(*parts):
+    return pj(staged_prefix(CURRENT_TARGET), *parts)
+
+
+def stage_version_dir(target, key):
+    return pj(STAGE_DIR, f"{target}@{key[:16]}")
+
+
+def read_stage_manifest(path):
+    try:
+        with open(pj(path, STAGE_MANIFEST_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def retire_stage(target):
+    # A published stage is kept for a rollback, anything else is a leftover of a failed build
+    manifest = read_stage_manifest(stage_dir(target))
+    if manifest is not None and manifest.get("key") is not None:
+        version_dir = stage_version_dir(target, manifest["key"])
+        shutil.rmtree(version_dir, ignore_errors=True)
+        os.replace(stage_dir(target), version_dir)
+        # The most recently retired versions are the likeliest to come back
+        os.utime(version_dir)
+    else:
+        shutil.rmtree(stage_dir(target), ignore_errors=True)
+    versions = sorted((pj(STAGE_DIR, x) for x in os.listdir(STAGE_DIR) if x.startswith(f"{target}@")),
+                      key=os.path.getmtime, reverse=True)
+    for version_dir in versions[STAGE_VERSIONS_KEPT:]:
+        shutil.rmtree(version_dir, ignore_errors=True)
+
+
+def reset_stage(target):
+    if fex(stage_dir(target)):
+        retire_stage(target)
+    mkdir(stage_dir(target))
+
+
+def rollback_stage(target):
+    # The release still has files of the published version, so its stage goes back as well
+    if read_stage_manifest(stage_dir(target)) is not None:
+        return
+    stamp = read_build_stamp(target)
+    shutil.rmtree(stage_dir(target), ignore_errors=True)
+    if stamp is not None and fex(stage_version_dir(target, stamp["key"])):
+        print(f"Restoring the previous stage of {target}")
+        os.replace(stage_version_dir(target, stamp["key"]), stage_dir(target))
+
+
+def relink_stage_version(target):
+    version_dir = stage_version_dir(target, TARGET_KEYS[target])
+    if not fex(version_dir):
+        return False
+    print(f"Relinking {target} from its kept stage {version_dir}")
+    with phase("restore"):
+        if fex(stage_dir(target)):
+            retire_stage(target)
+        os.replace(version_dir, stage_dir(target))
+        publish_stage(target)
+    write_build_stamp(target)
+    return True
+
+
+def staged_files(target):
+    prefix = staged_prefix(target)
+    result = []
+    for root, dirs, files in os.walk(prefix):
+        for name in dirs + files:
+            path = pj(root, name)
+            if name in files or os.path.islink(path):
+                result.append(os.path.relpath(path, prefix))
+    return sorted(result)
+
+
+def published_files(exclude_target):
+    result = set()
+    for name in os.listdir(STAGE_DIR):
+        if name != exclude_target and "@" not in name:
+            manifest = read_stage_manifest(pj(STAGE_DIR, name))
+            if manifest is not None:
+                result.update(manifest["files"])
+    return result
+
+
+def unpublish_stale_files(target, files):
+    # Files of the version in the release that the new one doesn't install, unless another target owns them
+    stamp = read_build_stamp(target)
+    previous = read_stage_manifest(stage_version_dir(target, stamp["key"])) if stamp is not None else None
+    if previous is None:
+        return
+    stale = set(previous["files"]) - set(files) - published_files(target)
+    for rel_path in sorted(stale):
+        if os.path.lexists(pj(RELEASE_DIR, rel_path)):
+            os.remove(pj(RELEASE_DIR, rel_path))
+    if stale:
+        print(f"Removed {len(stale)} files of the previous version of {target} from {RELEASE_DIR}")
+
+
+def publish_stage(target):
+    prefix = staged_prefix(target)
+    files = staged_files(target)
+    print(f"Publishing {len(files)} files of {target} into {RELEASE_DIR}")
+    unpublish_stale_files(target, files)
+    copied = 0
+    for rel_path in files:
+        src = pj(prefix, rel_path)
+        dest = pj(RELEASE_DIR, rel_path)
+        pathlib.Path(dest).parent.mkdir(parents=True, exist_ok=True)
+        if os.path.lexists(dest):
+            os.remove(dest)
+        if os.path.islink(src):
+            os.symlink(os.readlink(src), dest)
+            continue
+        try:
+            os.link(src, dest)
+        except OSError:
+            # Stage and release on different filesystems, or no hardlinks there at all
+            shutil.copy2(src, dest)
+            copied += 1
+    if copied:
+        print(f"Hardlinks are not available, {copied} files of {target} were copied")
+    with open(pj(stage_dir(target), STAGE_MANIFEST_FILE), "w") as f:
+        json.dump({"target": target, "key": TARGET_KEYS.get(target), "files": files}, f, indent=2)
+
+
+def is_http_url(location):
+    return location.startswith("http://") or location.startswith("https://")
+
+
+def artifact_name(target):
+    return f"{target}-{TARGET_KEYS[target]}.tar.gz"
+
+
+def artifact_location(target):
+    if is_http_url(args.artifact_cache):
+        return f"{args.artifact_cache.rstrip('/')}/{artifact_name(target)}"
+    return pj(args.artifact_cache, artifact_name(target))
+
+
+def artifact_available(target):
+    if args.artifact_cache is None:
+        return False
+    location = artifact_location(target)
+    if not is_http_url(location):
+        return fex(location)
+    try:
+        with urllib.request.urlopen(urllib.request.Request(location, method="HEAD"), timeout=30):
+            return True
+    except (urllib.error.URLError, OSError):
+        return False
+
+
+def pack_artifact(target, path):
+    prefix = staged_prefix(target)
+    manifest = {"target": target, "key": TARGET_KEYS.get(target), "prefix": cpp(RELEASE_DIR),
+                "native_prefix": RELEASE_DIR, "files": staged_files(target)}
+    with tarfile.open(path, "w:gz") as archive:
+        manifest_data = json.dumps(manifest, indent=2).encode()
+        info = tarfile.TarInfo("manifest.json")
+        info.size = len(manifest_data)
+        archive.addfile(info, io.BytesIO(manifest_data))
+        for rel_path in manifest["files"]:
+            archive.add(pj(prefix, rel_path), arcname=f"files/{rel_path}", recursive=False)
+
+
+def export_artifact(target):
+    location = artifact_location(target)
+    temp_path = pj(TARGET_DIR, f"{artifact_name(target)}.part")
+    print(f"Exporting artifact {location}")
+    pack_artifact(target, temp_path)
+    try:
+        if is_http_url(location):
+            with open(temp_path, "rb") as f:
+                request = urllib.request.Request(location, data=f, method="PUT")
+                request.add_header("Content-Length", str(os.path.getsize(temp_path)))
+                urllib.request.urlopen(request, timeout=300).close()
+        else:
+            mkdir(args.artifact_cache)
+            os.replace(temp_path, location)
+    except (urllib.error.URLError, OSError) as e:
+        # The build itself is fine, so a broken cache should never fail it
+        print(f"Failed to export artifact {location}: {e}")
+    finally:
+        if fex(temp_path):
+            os.remove(temp_path)
+
+
+def relocate_file(path, old_prefixes, new_prefix):
+    # Only text files (.pc, .la, cmake configs, *-config scripts) can be patched safely
+    with open(path, "rb") as f:
+        content = f.read()
+    if b"\0" in content:
+        return
+    patched = content
+    for old_prefix in old_prefixes:
+        patched = patched.replace(old_prefix.encode(), new_prefix.encode())
+    if patched != content:
+        with open(path, "wb") as f:
+            f.write(patched)
+
+
+def checked_artifact_members(members, dest):
+    # Artifacts come from a shared cache or another host, so nothing in them may land outside the stage.
+    # Used only when tarfile has no extraction filters (before Python 3.8.17)
+    dest = os.path.realpath(dest)
+
+    def inside(path):
+        path = os.path.realpath(path)
+        return path == dest or path.startswith(dest + os.sep)
+
+    for member in members:
+        if os.path.isabs(member.name) or ".." in pathlib.PurePosixPath(member.name).parts \
+                or not inside(pj(dest, member.name)):
+            raise tarfile.TarError(f"{member.name} points outside of the artifact")
+        if member.issym() and (os.path.isabs(member.linkname) or
+                               not inside(pj(dest, os.path.dirname(member.name), member.linkname))):
+            raise tarfile.TarError(f"{member.name} links to {member.linkname} outside of the artifact")
+        if member.islnk() and not inside(pj(dest, member.linkname)):
+            raise tarfile.TarError(f"{member.name} links to {member.linkname} outside of the artifact")
+        if not (member.isfile() or member.isdir() or member.issym() or member.islnk()):
+            raise tarfile.TarError(f"{member.name} is not a regular file, directory or link")
+    return members
+
+
+def unpack_artifact(target, archive_file):
+    reset_stage(target)
+    prefix = stage_dir(target) + cpp(RELEASE_DIR)
+    with tarfile.open(archive_file) as archive:
+        manifest = json.load(archive.extractfile("manifest.json"))
+        members = [m for m in archive.getmembers() if m.name.startswith("files/")]
+        for member in members:
+            member.name = member.name[len("files/"):]
+            if member.islnk() and member.linkname.startswith("files/"):
+                member.linkname = member.linkname[len("files/"):]
+        if hasattr(tarfile, "data_filter"):
+            archive.extractall(prefix, members=members, filter="data")
+        else:
+            archive.extractall(prefix, members=checked_artifact_members(members, prefix))
+        extracted = {m.name for m in members}
+
+    if manifest["prefix"] != cpp(RELEASE_DIR):
+        print(f"Relocating artifact from {manifest['prefix']} to {cpp(RELEASE_DIR)}")
+        # The manifest is as untrusted as the files, only what was extracted above may be patched
+        for rel_path in manifest["files"]:
+            if rel_path.replace(os.sep, "/") not in extracted:
+                continue
+            path = pj(prefix, rel_path)
+            if os.path.isfile(path) and not os.path.islink(path):
+                relocate_file(path, (manifest["prefix"], manifest["native_prefix"]), cpp(RELEASE_DIR))
+
+
+def import_artifact(target):
+    location = artifact_location(target)
+    temp_path = pj(TARGET_DIR, f"{artifact_name(target)}.part")
+    try:
+        if is_http_url(location):
+            with urllib.request.urlopen(location, timeout=300) as response, open(temp_path, "wb") as f:
+                shutil.copyfileobj(response, f)
+            archive_file = temp_path
+        else:
+            archive_file = location
+        unpack_artifact(target, archive_file)
+    except (urllib.error.URLError, OSError, tarfile.TarError, KeyError, ValueError) as e:
+        print(f"Failed to import artifact {location}: {e}")
+        return False
+    finally:
+        if fex(temp_path):
+            os.remove(temp_path)
+    return True
+
+
+def restore_artifact(target):
+    if not artifact_available(target):
+        return False
+    print(f"Restoring {target} from artifact {artifact_location(target)}")
+    with phase("restore"):
+        if not import_artifact(target):
+            return False
+        publish_stage(target)
+    write_build_stamp(target)
+    return True
 
 
 def command_exists(cmd):
@@ -361,7 +1400,7 @@ def require_commands(*cmds):
 
 
 def target_cwd(*dirs):
-    result_dir = TARGET_DIR
+    result_dir = WORK_DIR
     for curr_dir in dirs:
         result_dir = pj(result_dir, curr_dir)
     return local.cwd(result_dir)
@@ -371,27 +1410,400 @@ def clean_all():
     print("Cleaning started")
     rmdir(RELEASE_DIR)
     rmdir(TARGET_DIR)
+    rmdir(WORKER_DIR)
     print("Cleaning finished")
 
 
+# Cache management
+# Source and build trees in targets/ and archives in the download cache are kept between builds, so unchanged
+# targets don't have to be downloaded and extracted again. Every use of a tree or an archive bumps its mtime,
+# which is its last use then: atime is useless with noatime/relatime mounts, and mtimes need no shared index
+# that parallel targets would fight over. --gc removes trees that no declared target uses anymore (old ffmpeg
+# snapshots, previous cmake versions), and archives too when the download cache is inside the checkout.
+# With --cache-size it also removes least recently used trees, and archives as the last resort, until everything
+# fits. Stamps, stages and the release are never touched.
+# Directories of the builder itself, not source or build trees
+BUILDER_DIRS = ("stage", "reports", "logs", "pgo", "remote", "compiler-cache-bin", "compiler-cache-stats",
+                "configure-cache")
+SIZE_SUFFIXES = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_size(value):
+    value = value.strip().upper().rstrip("B")
+    if value and value[-1] in SIZE_SUFFIXES:
+        return int(float(value[:-1]) * SIZE_SUFFIXES[value[-1]])
+    return int(value)
+
+
+CACHE_SIZE_LIMIT = parse_size(args.cache_size) if args.cache_size is not None else None
+
+
+def format_size(size):
+    for suffix in ("T", "G", "M", "K"):
+        if size >= SIZE_SUFFIXES[suffix]:
+            return f"{size / SIZE_SUFFIXES[suffix]:.1f} {suffix}B"
+    return f"{size} B"
+
+
+def disk_usage(path):
+    if not os.path.isdir(path) or os.path.islink(path):
+        return os.lstat(path).st_size if os.path.lexists(path) else 0
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(pj(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def touch_cache_entry(path):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def referenced_work_trees():
+    # target -> top directories of its trees, as they are named in this version of the script
+    return {name: [os.path.basename(x) for x in work_tree_dirs(name)] for name in TARGET_REGISTRY}
+
+
+def download_cache_shared():
+    # The default cache in ~/.cache serves every checkout and version of this script, and we know only our targets
+    cache = os.path.realpath(DOWNLOAD_CACHE_DIR)
+    return not cache.startswith(os.path.realpath(CWD) + os.sep)
+
+
+def referenced_archives():
+    return {os.path.basename(archive_path(t.source)) for t in TARGET_REGISTRY.values() if t.source is not None}
+
+
+def cache_entries():
+    # (path, last used, size, kind, owner); owner is None for something no declared target uses anymore
+    entries = []
+    owners = {tree: name for name, trees in referenced_work_trees().items() for tree in trees}
+    stamps = {extraction_stamp_file_name(t.source): name for name, t in TARGET_REGISTRY.items()
+              if t.source is not None}
+    if fex(TARGET_DIR):
+        for name in os.listdir(TARGET_DIR):
+            path = pj(TARGET_DIR, name)
+            if os.path.isdir(path) and name not in BUILDER_DIRS:
+                entries.append((path, os.path.getmtime(path), disk_usage(path), "tree", owners.get(name)))
+            elif name.endswith(".extracted") and path not in stamps:
+                entries.append((path, os.path.getmtime(path), disk_usage(path), "tree", None))
+    archives = referenced_archives()
+    shared = download_cache_shared()
+    if fex(DOWNLOAD_CACHE_DIR):
+        for name in os.listdir(DOWNLOAD_CACHE_DIR):
+            path = pj(DOWNLOAD_CACHE_DIR, name)
+            # Checksums, partial downloads and locks go together with their archive
+            base_name = re.sub(r"\.(sha256|part|lock)$", "", name)
+            if base_name != name and fex(pj(DOWNLOAD_CACHE_DIR, base_name)):
+                continue
+            # Archives of a shared cache are never unused, other checkouts may need them. Only the size limit applies
+            owner = base_name if base_name in archives or shared else None
+            size = sum(disk_usage(pj(DOWNLOAD_CACHE_DIR, base_name + x)) for x in ("", ".sha256", ".part", ".lock"))
+            entries.append((pj(DOWNLOAD_CACHE_DIR, base_name), os.path.getmtime(path), size, "archive", owner))
+    return entries
+
+
+def evict_cache_entry(path, kind):
+    if kind == "archive":
+        with file_lock(path):
+            for suffix in ("", ".sha256", ".part"):
+                if os.path.lexists(path + suffix):
+                    os.remove(path + suffix)
+        if fex(f"{path}.lock"):
+            os.remove(f"{path}.lock")
+    elif os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+        # Its extraction stamp would claim the tree is still there
+        for name, trees in referenced_work_trees().items():
+            source = TARGET_REGISTRY[name].source
+            if os.path.basename(path) in trees and source is not None and fex(extraction_stamp_file_name(source)):
+                os.remove(extraction_stamp_file_name(source))
+    else:
+        os.remove(path)
+
+
+def collect_garbage(remove_unused):
+    entries = cache_entries()
+    total = sum(x[2] for x in entries)
+    # Unused trees first, then least recently used trees, then archives nobody needs, then the rest of archives
+    order = {("tree", False): 0, ("tree", True): 1, ("archive", False): 2, ("archive", True): 3}
+    candidates = sorted(entries, key=lambda x: (order[(x[3], x[4] is not None)], x[1]))
+    reclaimed = 0
+    removed = 0
+    for path, last_used, size, kind, owner in candidates:
+        unused = owner is None and remove_unused
+        if not unused and (CACHE_SIZE_LIMIT is None or total - reclaimed <= CACHE_SIZE_LIMIT):
+            continue
+        if owner is None:
+            reason = "not used anymore"
+        else:
+            reason = f"last used {time.strftime('%Y-%m-%d %H:%M', time.localtime(last_used))}"
+        print(f"Removing {kind} {path} ({format_size(size)}, {reason})")
+        try:
+            evict_cache_entry(path, kind)
+        except OSError as e:
+            print(f"Failed to remove {path}: {e}")
+            continue
+        reclaimed += size
+        removed += 1
+    limit = f" of {format_size(CACHE_SIZE_LIMIT)}" if CACHE_SIZE_LIMIT is not None else ""
+    print_block(f"Reclaimed {format_size(reclaimed)} in {removed} trees and archives, "
+                f"{format_size(total - reclaimed)}{limit} left")
+
+
+# Resources
+# The job count follows what the build may actually use: CPU affinity, cgroup CPU quota (Kubernetes pods,
+# docker --cpus) and memory. Every target has a memory weight, an estimate of peak RSS of one of its compile jobs,
+# and targets are started only while their jobs fit into memory that is still available.
+CGROUP_DIR = "/sys/fs/cgroup"
+MEMORY_PER_JOB_DEFAULT = 256
+# Left for the builder itself, the page cache and whatever else runs on the host (MB)
+MEMORY_RESERVE = 512
+# Percentage of time tasks were stalled on memory during the last 10 seconds (PSI "some avg10")
+MEMORY_PRESSURE_LIMIT = 10.0
+MEMORY_PRESSURE_POLL_INTERVAL = 5
+LOAD_LIMIT = None
+
+
+def read_text(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def cgroup_dirs(controller):
+    # "0::/kubepods/pod1/abc" for cgroup v2, "4:cpu,cpuacct:/docker/abc" for v1
+    result = []
+    for line in (read_text("/proc/self/cgroup") or "").splitlines():
+        parts = line.split(":", 2)
+        if len(parts) != 3:
+            continue
+        hierarchy, controllers, path = parts
+        if hierarchy == "0" and not controllers:
+            result.append(pj(CGROUP_DIR, path.lstrip("/")))
+        elif controller in controllers.split(","):
+            result.append(pj(CGROUP_DIR, controllers, path.lstrip("/")))
+            result.append(pj(CGROUP_DIR, controller, path.lstrip("/")))
+    # Containers usually see their own cgroup mounted as the root
+    result += [CGROUP_DIR, pj(CGROUP_DIR, controller)]
+    return result
+
+
+def cgroup_cpu_limit():
+    for path in cgroup_dirs("cpu"):
+        cpu_max = read_text(pj(path, "cpu.max"))
+        if cpu_max is not None:
+            quota, period = (cpu_max.split() + ["100000"])[:2]
+            return None if quota == "max" else max(1, math.ceil(int(quota) / int(period)))
+        quota = read_text(pj(path, "cpu.cfs_quota_us"))
+        period = read_text(pj(path, "cpu.cfs_period_us"))
+        if quota is not None and period is not None:
+            return None if int(quota) <= 0 else max(1, math.ceil(int(quota) / int(period)))
+    return None
+
+
+def cgroup_memory_available():
+    for path in cgroup_dirs("memory"):
+        limit, usage, stat, inactive = read_text(pj(path, "memory.max")), read_text(pj(path, "memory.current")), \
+            read_text(pj(path, "memory.stat")), "inactive_file"
+        if limit is None:
+            limit, usage, stat, inactive = read_text(pj(path, "memory.limit_in_bytes")), \
+                read_text(pj(path, "memory.usage_in_bytes")), read_text(pj(path, "memory.stat")), \
+                "total_inactive_file"
+        if limit is None:
+            continue
+        # v1 reports "no limit" as a huge number close to 2^63
+        if limit == "max" or int(limit) >= 1 << 60:
+            return None
+        # Usage includes page cache, and the inactive part of it is reclaimed before anybody gets OOM-killed
+        reclaimable = re.search(rf"^{inactive} (\d+)$", stat or "", re.MULTILINE)
+        used = int(usage or 0) - (int(reclaimable.group(1)) if reclaimable else 0)
+        return (int(limit) - used) // (1024 * 1024)
+    return None
+
+
+def available_memory():
+    # In megabytes, None when unknown (MacOS, Windows)
+    values = []
+    meminfo = re.search(r"^MemAvailable:\s+(\d+) kB$", read_text("/proc/meminfo") or "", re.MULTILINE)
+    if meminfo:
+        values.append(int(meminfo.group(1)) // 1024)
+    cgroup_memory = cgroup_memory_available()
+    if cgroup_memory is not None:
+        values.append(cgroup_memory)
+    return max(0, min(values) - MEMORY_RESERVE) if values else None
+
+
+def memory_pressure():
+    for path in [pj(x, "memory.pressure") for x in cgroup_dirs("memory")] + ["/proc/pressure/memory"]:
+        pressure = re.search(r"some avg10=([\d.]+)", read_text(path) or "")
+        if pressure:
+            return float(pressure.group(1))
+    return None
+
+
+def available_cpus():
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or JOBS_DEFAULT
+    quota = cgroup_cpu_limit()
+    return min(cpus, quota) if quota is not None else cpus
+
+
 def set_jobs_num():
     global JOBS
+    global LOAD_LIMIT
     global FFMPEG_CONFIGURE_EXTENDED_OPTIONS
 
-    if args.jobs is not None:
-        JOBS = args.jobs
-    elif fex("/proc/cpuinfo"):
-        # Linux
-        rslt = bg_content("grep", "-c", "processor", "/proc/cpuinfo")
-        JOBS = rslt.stdout.rstrip()
-    elif OS_TYPE == OS_TYPE_MAC:
-        # Mac
-        rslt = bg_content("sysctl", "-n", "machdep.cpu.thread_count")
-        JOBS = rslt.stdout.rstrip()
+    if OS_TYPE == OS_TYPE_MAC:
         FFMPEG_CONFIGURE_EXTENDED_OPTIONS = ("--enable-videotoolbox",)
-    else:
-        # TODO: Windows
-        JOBS = JOBS_DEFAULT
+
+    cpus = available_cpus()
+    JOBS = args.jobs if args.jobs is not None else cpus
+    # Load average is counted for the whole host, even inside a container, so there's no sensible default for it
+    LOAD_LIMIT = args.load_average
+    memory = available_memory()
+    print_block(f"Jobs: {JOBS} ({cpus} CPUs available), load limit: {LOAD_LIMIT or 'none'}, "
+                f"available memory: {f'{memory} MB' if memory is not None else 'unknown'}")
+
+
+# Work trees
+# With --tmpfs, sources of a target are extracted and built in a RAM-backed directory instead of targets/,
+# which may be on slow network storage. Archives, stamps, stages and the release stay on disk, and a work tree
+# on tmpfs is removed as soon as its target is installed. A target goes to tmpfs only when the expected size
+# of its tree fits into free tmpfs space and into the memory budget, otherwise it's built on disk as usual.
+WORK_DIR = TARGET_DIR
+# Unpacked sources with objects compared to the compressed archive, used until a target has history
+WORK_TREE_ARCHIVE_RATIO = 8
+WORK_TREE_DEFAULT_SIZE = 512
+
+
+def tmpfs_work_dir(target):
+    # Several checkouts and matrix variants may share one tmpfs
+    checkout = hashlib.sha256(str(TARGET_DIR).encode()).hexdigest()[:8]
+    return pj(args.tmpfs_dir, f"ffmpeg-builder-{checkout}", target)
+
+
+def tmpfs_free():
+    # In megabytes, None when there's no usable tmpfs
+    if args.tmpfs_dir is None or not hasattr(os, "statvfs") or not os.path.isdir(args.tmpfs_dir):
+        return None
+    stat = os.statvfs(args.tmpfs_dir)
+    return stat.f_bavail * stat.f_frsize // (1024 * 1024)
+
+
+def work_tree_dirs(target):
+    t = TARGET_REGISTRY[target]
+    return [pj(WORK_DIR, x) for x in sorted({x[0] for x in (t.source_dir, t.build_dir) if x})]
+
+
+def tree_size(paths):
+    return sum(disk_usage(x) for x in paths) // (1024 * 1024)
+
+
+def save_work_tree_size(target):
+    mkdir(REPORTS_DIR)
+    with open(pj(REPORTS_DIR, f"{target}.tree.json"), "w") as f:
+        json.dump({"tree_mb": tree_size(work_tree_dirs(target))}, f)
+
+
+def work_tree_estimate(target, history):
+    sizes = [x["tree_mb"] for x in history.get(target, []) if "tree_mb" in x]
+    if sizes:
+        return max(sizes)
+    source = TARGET_REGISTRY[target].source
+    if source is not None and fex(archive_path(source)):
+        return os.path.getsize(archive_path(source)) * WORK_TREE_ARCHIVE_RATIO // (1024 * 1024) + 1
+    return WORK_TREE_DEFAULT_SIZE
+
+
+# Configure cache
+# With --configure-cache every autoconf configure gets a --cache-file shared by all targets, so checks
+# for headers, functions and compiler features that every library repeats are done once. The shared file is keyed
+# on the compiler, flags and OS, which is all those results depend on. A target works on its own copy,
+# and new results are merged back under a lock. Results that depend on what's already installed in the release
+# (libraries, pkg-config modules, missing headers, paths into our directories) are never shared, nor are ac_cv_env_*,
+# which only record environment of the target that wrote them and make other configure scripts refuse to run.
+# If configure fails with the cache, it's retried without it, and the results of that run are not merged.
+# When the retry works, the shared results that target was given are dropped, one of them must be wrong.
+CONFIGURE_CACHE_DIR = pj(TARGET_DIR, "configure-cache")
+CONFIGURE_CACHE_LINE = re.compile(r"^(?:test \"\$\{(\w+)\+set\}\" = set \|\| )?(\w+)=")
+CONFIGURE_CACHE_PRIVATE = ("ac_cv_env_", "ac_cv_lib_", "pkg_cv_")
+
+
+def is_autoconf_script(path):
+    with open(path, errors="replace") as f:
+        return "Generated by GNU Autoconf" in f.read(4096)
+
+
+def configure_cache_file():
+    inputs = {"toolchain": toolchain_identity(),
+              "environment": {var: local.env.get(var) for var in TOOLCHAIN_ENV_VARS},
+              "flags": {"CC": str(CC), "CFLAGS": CFLAGS, "LDFLAGS": LDFLAGS},
+              "os": OS_TYPE}
+    key = hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+    return pj(CONFIGURE_CACHE_DIR, f"{key[:16]}.cache")
+
+
+def read_configure_cache(path):
+    # var -> its line, only well-formed lines of results we may share
+    entries = {}
+    if not fex(path):
+        return entries
+    # Results mentioning our own directories don't hold for other targets. Work trees on tmpfs are removed
+    # after the build, so paths into them would point nowhere at all
+    private_dirs = {RELEASE_DIR, TARGET_DIR, WORK_DIR}
+    if args.tmpfs_dir is not None:
+        private_dirs.add(args.tmpfs_dir)
+    private_dirs = tuple(private_dirs | {cpp(x) for x in private_dirs})
+    with open(path, errors="replace") as f:
+        for line in f:
+            match = CONFIGURE_CACHE_LINE.match(line)
+            if match is None or "_cv_" not in match.group(2):
+                continue
+            name = match.group(2)
+            if name.startswith(CONFIGURE_CACHE_PRIVATE) or any(x in line for x in private_dirs):
+                continue
+            # A header missing now may be installed by the next target (ogg/ogg.h for libvorbis)
+            if name.startswith("ac_cv_header_") and line.rstrip().endswith("=no}"):
+                continue
+            entries[name] = line if line.endswith("\n") else line + "\n"
+    return entries
+
+
+def merge_configure_cache(shared_file, private_file):
+    with file_lock(shared_file):
+        entries = read_configure_cache(shared_file)
+        added = {k: v for k, v in read_configure_cache(private_file).items() if k not in entries}
+        if not added:
+            return
+        entries.update(added)
+        write_configure_cache(shared_file, entries)
+    print(f"Added {len(added)} results to the configure cache")
+
+
+def write_configure_cache(shared_file, entries):
+    with open(f"{shared_file}.part", "w") as f:
+        f.write("# Shared by ffmpeg-builder.py, see configure_cache_file()\n")
+        f.writelines(entries[x] for x in sorted(entries))
+    os.replace(f"{shared_file}.part", shared_file)
+
+
+def drop_configure_cache_entries(shared_file, used):
+    with file_lock(shared_file):
+        entries = read_configure_cache(shared_file)
+        # Results changed or added since then were not given to the failed configure
+        dropped = [k for k, v in used.items() if entries.get(k) == v]
+        for k in dropped:
+            del entries[k]
+        write_configure_cache(shared_file, entries)
+    print(f"Dropped {len(dropped)} results from the configure cache: {shared_file}")
 
 
 def configure(prefix, *opts):
@@ -399,16 +1811,43 @@ def configure(prefix, *opts):
     if OS_TYPE_WINDOWS == OS_TYPE:
         new_opts = ("bash",) + new_opts
     fg("chmod", "+x", "./configure")
+    shared_file = None
+    if args.configure_cache and is_autoconf_script("./configure"):
+        mkdir(CONFIGURE_CACHE_DIR)
+        shared_file = configure_cache_file()
+        private_file = pj(CONFIGURE_CACHE_DIR, f"{CURRENT_TARGET}.cache")
+        with file_lock(shared_file), open(private_file, "w") as f:
+            # Only validated entries, a cache file is sourced by the shell as is
+            used = read_configure_cache(shared_file)
+            f.writelines(used.values())
     print(f"Configure with flags: {new_opts}")
-    if not fg(*new_opts):
-        fail()
+    with phase("configure"):
+        if shared_file is not None:
+            if fg(*new_opts, f"--cache-file={cpp(private_file)}"):
+                merge_configure_cache(shared_file, private_file)
+                print("Configuring done.")
+                return
+            print(f"Configure of {CURRENT_TARGET} failed with the shared cache, retrying without it")
+        if not fg(*new_opts):
+            fail()
+        if shared_file is not None:
+            # Works without the cache, so the cache is poisoned, at least for this target
+            drop_configure_cache_entries(shared_file, used)
     print("Configuring done.")
 
 
 def make(*opts):
     print(f"Making...")
-    if not fg("make", "-j", JOBS, *opts):
-        fail()
+    with phase("make"):
+        load_opts = ("-l", LOAD_LIMIT) if LOAD_LIMIT is not None else ()
+        if MAKE_JOBSERVER is not None:
+            # -j on the command line would make a private jobserver instead of joining ours
+            with local.env(MAKEFLAGS=jobserver_makeflags(MAKE_JOBSERVER)):
+                succeeded = fg("make", *load_opts, *opts, pass_fds=(MAKE_JOBSERVER,))
+        else:
+            succeeded = fg("make", "-j", JOBS, *load_opts, *opts)
+        if not succeeded:
+            fail()
     print(f"Making done.")
 
 
@@ -440,379 +1879,2237 @@ def cmake(*opts):
     # https://stackoverflow.com/questions/41492504/how-to-get-native-windows-path-inside-msys-python
     # TODO: implement command line option to switch between versions of CMake, protect with cpp(RELEASE_DIR)
 
-    if not fg("cmake", f"-DCMAKE_INSTALL_PREFIX:PATH={RELEASE_DIR}", *opts):
-        fail()
+    opts = opts + time_trace_cmake_options(CURRENT_TARGET)
+    with phase("configure"):
+        if not fg("cmake", f"-DCMAKE_INSTALL_PREFIX:PATH={RELEASE_DIR}", *opts):
+            fail()
     print(f"Making with CMake done.")
 
 
 def install(*opts):
     print("Installing...")
-    if not fg("make", "install", *opts):
-        fail()
+    with phase("install"):
+        if not fg("make", "install", f"DESTDIR={cpp(stage_dir(CURRENT_TARGET))}", *opts):
+            fail()
     print("Installation done.")
 
 
-def build_all():
-    print_header("Building process started")
-    mkdirs(TARGET_DIR, RELEASE_DIR)
+# Compiler cache
+# With --compiler-cache every compiler found in PATH is shadowed by a tiny wrapper that runs it through
+# ccache or sccache. Both autoconf-style configure scripts and CMake pick compilers from PATH,
+# so all targets are covered without touching their recipes.
+COMPILER_CACHE_CCACHE = "ccache"
+COMPILER_CACHE_SCCACHE = "sccache"
+COMPILER_CACHE_BIN_DIR = pj(TARGET_DIR, "compiler-cache-bin")
+COMPILER_CACHE_STATS_DIR = pj(TARGET_DIR, "compiler-cache-stats")
+SCCACHE_BASE_PORT = 4300
+
+
+def setup_compiler_cache():
+    if args.compiler_cache is None:
+        return
+
+    launcher = args.compiler_cache
+    require_commands(launcher)
+    mkdirs(COMPILER_CACHE_BIN_DIR, COMPILER_CACHE_STATS_DIR)
+    for cmd in TOOLCHAIN_COMMANDS:
+        real_cmd = find_real_command(cmd)
+        if real_cmd is None:
+            continue
+        wrapper = pj(COMPILER_CACHE_BIN_DIR, cmd)
+        with open(wrapper, "w") as f:
+            f.write(f'#!/bin/sh\nexec {launcher} "{cpp(real_cmd)}" "$@"\n')
+        os.chmod(wrapper, 0o755)
+    push_path(COMPILER_CACHE_BIN_DIR)
+
+    if launcher == COMPILER_CACHE_CCACHE:
+        # Paths inside the checkout are rewritten to relative ones, so different checkouts share hits
+        local.env["CCACHE_BASEDIR"] = str(CWD)
+        if args.compiler_cache_dir is not None:
+            local.env["CCACHE_DIR"] = args.compiler_cache_dir
+        if args.compiler_cache_size is not None:
+            fg(launcher, f"--max-size={args.compiler_cache_size}")
+    else:
+        if args.compiler_cache_dir is not None:
+            local.env["SCCACHE_DIR"] = args.compiler_cache_dir
+        if args.compiler_cache_size is not None:
+            local.env["SCCACHE_CACHE_SIZE"] = args.compiler_cache_size
+    print_block(f"Compilers are launched through {launcher}")
+
+
+def compiler_cache_stats_file(target):
+    return pj(COMPILER_CACHE_STATS_DIR, f"{target}.json")
+
+
+def begin_compiler_cache_stats(target):
+    if args.compiler_cache is None:
+        return
+    if fex(compiler_cache_stats_file(target)):
+        os.remove(compiler_cache_stats_file(target))
+    if args.compiler_cache == COMPILER_CACHE_CCACHE:
+        # Every ccache invocation appends its result to this log, so targets built in parallel don't mix up
+        stats_log = pj(COMPILER_CACHE_STATS_DIR, f"{target}.log")
+        if fex(stats_log):
+            os.remove(stats_log)
+        local.env["CCACHE_STATSLOG"] = stats_log
+    else:
+        # sccache counts everything in its server, so every target gets a private server on its own port
+        index = list(TARGET_REGISTRY).index(target)
+        local.env["SCCACHE_SERVER_PORT"] = str(SCCACHE_BASE_PORT + index)
+        sfg(COMPILER_CACHE_SCCACHE, "--start-server")
+
+
+def end_compiler_cache_stats(target):
+    if args.compiler_cache is None:
+        return
+    hits, misses, uncacheable = 0, 0, 0
+    if args.compiler_cache == COMPILER_CACHE_CCACHE:
+        stats_log = pj(COMPILER_CACHE_STATS_DIR, f"{target}.log")
+        if fex(stats_log):
+            with open(stats_log) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line or line.startswith("#"):
+                        continue
+                    if line.endswith("cache_hit"):
+                        hits += 1
+                    elif line == "cache_miss":
+                        misses += 1
+                    else:
+                        uncacheable += 1
+    else:
+        result = bg_content(COMPILER_CACHE_SCCACHE, "--show-stats", "--stats-format=json")
+        sfg(COMPILER_CACHE_SCCACHE, "--stop-server")
+        try:
+            stats = json.loads(result.stdout)["stats"]
+            hits = sum(stats["cache_hits"]["counts"].values())
+            misses = sum(stats["cache_misses"]["counts"].values())
+            uncacheable = stats.get("requests_not_cacheable", 0) + stats.get("requests_not_compile", 0)
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Can't parse {COMPILER_CACHE_SCCACHE} statistics: {e}")
+    with open(compiler_cache_stats_file(target), "w") as f:
+        json.dump({"hits": hits, "misses": misses, "uncacheable": uncacheable}, f)
+
+
+def print_compiler_cache_report(targets):
+    if args.compiler_cache is None or not targets:
+        return
+    print_header(f"{args.compiler_cache} statistics (hits / misses / uncacheable, hit rate):")
+    total_hits, total_misses = 0, 0
+    for target in targets:
+        try:
+            with open(compiler_cache_stats_file(target)) as f:
+                stats = json.load(f)
+        except (OSError, ValueError):
+            continue
+        total_hits += stats["hits"]
+        total_misses += stats["misses"]
+        compiled = stats["hits"] + stats["misses"]
+        rate = f"{100 * stats['hits'] / compiled:.1f}%" if compiled else "n/a"
+        print(f"{target:>20}: {stats['hits']} / {stats['misses']} / {stats['uncacheable']}, {rate}")
+    total = total_hits + total_misses
+    print_block(f"{'total':>20}: {total_hits} / {total_misses}, "
+                f"{f'{100 * total_hits / total:.1f}%' if total else 'n/a'}")
+
+
+# Optimized builds
+# With --optimized, ffmpeg and the encoders doing most of the work (x264, x265) are built by clang with ThinLTO
+# and profile-guided optimization. They are built with instrumentation first, the instrumented ffmpeg encodes
+# generated lavfi sources, and then they are rebuilt with the merged profile. The profile is kept together with
+# cache keys of the instrumented builds, so training runs again only when sources, options or toolchain change.
+OPTIMIZED_TARGETS = ("x264", "x265", "ffmpeg")
+PGO_STAGE_INSTRUMENT = "instrument"
+PGO_STAGE_USE = "use"
+PGO_STAGE = None
+PGO_PROFILE_SHA256 = None
+PGO_DIR = pj(TARGET_DIR, "pgo")
+PGO_RAW_DIR = pj(PGO_DIR, "raw")
+PGO_PROFILE_FILE = pj(PGO_DIR, "ffmpeg.profdata")
+PGO_PROFILE_INFO_FILE = pj(PGO_DIR, "ffmpeg.profdata.json")
+PGO_LLVM_COMMANDS = ("clang", "clang++", "llvm-profdata", "llvm-ar", "llvm-ranlib", "llvm-nm")
+PGO_TRAINING_DURATION = 10
+# Our farm mostly transcodes HD sources into H.264/HEVC ladders, so the training workload does the same
+PGO_TRAINING_RUNS = (
+    (("-f", "lavfi", "-i", "testsrc2=size=1920x1080:rate=30"),
+     ("-vf", "scale=1280:720", "-c:v", "libx264", "-preset", "veryfast")),
+    (("-f", "lavfi", "-i", "testsrc2=size=1280x720:rate=30"),
+     ("-c:v", "libx264", "-preset", "medium", "-b:v", "3M")),
+    (("-f", "lavfi", "-i", "testsrc2=size=1920x1080:rate=30"),
+     ("-vf", "scale=1280:720", "-c:v", "libx265", "-preset", "ultrafast")),
+    (("-f", "lavfi", "-i", "testsrc2=size=1280x720:rate=30"),
+     ("-c:v", "libx265", "-preset", "medium", "-b:v", "2M")),
+    (("-f", "lavfi", "-i", "sine=frequency=1000:sample_rate=48000"),
+     ("-c:a", "aac", "-b:a", "128k")),
+)
+
+
+def optimized(target):
+    return args.optimized_mode and target in OPTIMIZED_TARGETS
+
+
+def optimization_flags():
+    # Instrumented builds are thrown away after training, so they skip LTO. IR-level profiles are collected
+    # before inlining, so they still match the final LTO build.
+    if PGO_STAGE == PGO_STAGE_INSTRUMENT:
+        return "-fprofile-generate", "-fprofile-generate"
+    cflags = f"-flto=thin -fprofile-use={cpp(PGO_PROFILE_FILE)}"
+    # MacOS linker does LTO by itself, elsewhere the system linker may not understand LLVM bitcode
+    ldflags = cflags if OS_TYPE == OS_TYPE_MAC else f"{cflags} -fuse-ld=lld"
+    return cflags, ldflags
+
+
+def optimization_configure_options(target):
+    if not optimized(target):
+        return ()
+    cflags, ldflags = optimization_flags()
+    opts = (f"--extra-cflags={cflags}", f"--extra-ldflags={ldflags}")
+    if target == "ffmpeg":
+        # Unlike x264, ffmpeg's configure ignores CC, AR and friends from the environment
+        opts = opts + ("--cc=clang", "--cxx=clang++", "--ar=llvm-ar", "--ranlib=llvm-ranlib", "--nm=llvm-nm")
+    return opts
+
+
+def optimization_cmake_options(target):
+    if not optimized(target):
+        return ()
+    cflags, ldflags = optimization_flags()
+    return ("-DCMAKE_C_COMPILER=clang", "-DCMAKE_CXX_COMPILER=clang++",
+            # Static libraries full of bitcode need an archiver that can index it
+            f"-DCMAKE_AR={shutil.which('llvm-ar')}", f"-DCMAKE_RANLIB={shutil.which('llvm-ranlib')}",
+            f"-DCMAKE_C_FLAGS={cflags}", f"-DCMAKE_CXX_FLAGS={cflags}",
+            f"-DCMAKE_EXE_LINKER_FLAGS={ldflags}")
+
+
+def optimization_env(target):
+    if not optimized(target):
+        return {}
+    return {"CC": "clang", "CXX": "clang++", "AR": "llvm-ar", "RANLIB": "llvm-ranlib", "NM": "llvm-nm"}
+
+
+# Compile time profiling
+# With --time-trace, chosen targets are compiled by clang with -ftime-trace, which writes a Chrome trace next to
+# every object file. Right after the target is built, the traces are boiled down to per-unit times, inclusive
+# times of headers, template instantiations and compiler stages (frontend, optimization, codegen), and the
+# longest events are kept for a merged trace. Objects are spread over lanes like make -j runs them.
+TIME_TRACE_REPORT_FILE = pj(REPORTS_DIR, "time-trace-report.json")
+TIME_TRACE_FILE = pj(REPORTS_DIR, "time-trace.json")
+TIME_TRACE_REPORT_LINES = 15
+# Events shorter than this (microseconds) are left out of the merged trace, ffmpeg alone has thousands of objects
+TIME_TRACE_MIN_EVENT = 10000
+TIME_TRACE_TEMPLATE_EVENTS = ("InstantiateClass", "InstantiateFunction")
+
+
+def time_traced(target):
+    return target in split_targets(args.time_trace)
+
+
+def time_trace_env(target):
+    if not time_traced(target):
+        return {}
+    # Only clang can do it, and autoconf scripts read compilers and flags from the environment
+    return {"CC": "clang", "CXX": "clang++",
+            "CFLAGS": f"{local.env.get('CFLAGS', '')} -ftime-trace".strip(),
+            "CXXFLAGS": f"{local.env.get('CXXFLAGS', '')} -ftime-trace".strip()}
+
+
+def time_trace_configure_options(target):
+    if not time_traced(target):
+        return ()
+    # ffmpeg's configure ignores the environment
+    return "--cc=clang", "--cxx=clang++", "--extra-cflags=-ftime-trace"
+
+
+def time_trace_cmake_options(target):
+    cache = pj(str(local.cwd), "CMakeCache.txt")
+    if not time_traced(target):
+        # CMake keeps compilers and flags from the first run in its cache, so a traced tree has to forget them
+        if fex(cache):
+            with open(cache, errors="replace") as f:
+                if "-ftime-trace" in f.read():
+                    os.remove(cache)
+        return ()
+    env = time_trace_env(target)
+    # Given after optimization_cmake_options(), so they have to carry its flags too
+    cflags = optimization_flags()[0] if optimized(target) else ""
+    return (f"-DCMAKE_C_COMPILER={env['CC']}", f"-DCMAKE_CXX_COMPILER={env['CXX']}",
+            f"-DCMAKE_C_FLAGS={cflags} {env['CFLAGS']}".strip(),
+            f"-DCMAKE_CXX_FLAGS={cflags} {env['CXXFLAGS']}".strip())
+
+
+def find_time_traces(target, started):
+    result = []
+    for path in work_tree_dirs(target):
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                file_path = pj(root, name)
+                if not name.endswith(".json") or os.path.getmtime(file_path) < started:
+                    continue
+                with open(file_path, "rb") as f:
+                    if f.read(16).startswith(b'{"traceEvents":'):
+                        result.append(file_path)
+    return sorted(result)
+
+
+def collect_time_traces(target, started):
+    units = []
+    headers = {}
+    templates = {}
+    stages = {}
+    for path in find_time_traces(target, started):
+        with open(path) as f:
+            trace = json.load(f)
+        events = [x for x in trace["traceEvents"] if x.get("ph") == "X"]
+        totals = {x["name"][len("Total "):]: x["dur"] for x in events if x["name"].startswith("Total ")}
+        events = [x for x in events if not x["name"].startswith("Total ")]
+        total = totals.get("ExecuteCompiler", max((x["dur"] for x in events), default=0))
+        # Newer clang tells when the compiler started, otherwise the trace was written when it finished
+        begin = trace.get("beginningOfTime", os.path.getmtime(path) * 1000000 - total)
+        units.append({"name": os.path.relpath(path, WORK_DIR)[:-len(".json")], "total": total,
+                      "frontend": totals.get("Frontend", 0), "backend": totals.get("Backend", 0),
+                      "begin": begin,
+                      "events": [{"name": x["name"], "ts": x["ts"], "dur": x["dur"],
+                                  "detail": x.get("args", {}).get("detail")}
+                                 for x in events if x["dur"] >= TIME_TRACE_MIN_EVENT]})
+        for name, dur in totals.items():
+            stages[name] = stages.get(name, 0) + dur
+        for x in events:
+            detail = x.get("args", {}).get("detail")
+            if x["name"] == "Source" and detail:
+                headers.setdefault(detail, [0, 0])
+                headers[detail][0] += x["dur"]
+                headers[detail][1] += 1
+            elif x["name"] in TIME_TRACE_TEMPLATE_EVENTS and detail:
+                templates.setdefault(detail, [0, 0])
+                templates[detail][0] += x["dur"]
+                templates[detail][1] += 1
+    print(f"Collected {len(units)} time traces of {target}")
+    mkdir(REPORTS_DIR)
+    with open(pj(REPORTS_DIR, f"{target}.time-trace.json"), "w") as f:
+        json.dump({"target": target, "units": units, "headers": headers, "templates": templates, "stages": stages},
+                  f)
+
+
+def top_entries(entries):
+    # {name: [microseconds, count]} -> the slowest entries
+    return sorted(entries.items(), key=lambda x: -x[1][0])[:TIME_TRACE_REPORT_LINES]
+
+
+def write_time_trace_report():
+    traced = [x for x in split_targets(args.time_trace) if fex(pj(REPORTS_DIR, f"{x}.time-trace.json"))]
+    if not traced:
+        return
+    units = []
+    headers = {}
+    templates = {}
+    stages = {}
+    events = []
+    for pid, target in enumerate(traced, start=1):
+        with open(pj(REPORTS_DIR, f"{target}.time-trace.json")) as f:
+            data = json.load(f)
+        for kind, merged in ((data["headers"], headers), (data["templates"], templates)):
+            for name, (dur, count) in kind.items():
+                merged.setdefault(name, [0, 0])
+                merged[name][0] += dur
+                merged[name][1] += count
+        for name, dur in data["stages"].items():
+            stages[name] = stages.get(name, 0) + dur
+
+        events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": target}})
+        lanes = []
+        for unit in sorted(data["units"], key=lambda x: x["begin"]):
+            units.append(dict(unit, target=target, events=None))
+            lane = next((i for i, end in enumerate(lanes) if end <= unit["begin"]), len(lanes))
+            if lane == len(lanes):
+                lanes.append(0)
+            lanes[lane] = unit["begin"] + unit["total"]
+            events.append({"name": unit["name"], "cat": target, "ph": "X", "pid": pid, "tid": lane + 1,
+                           "ts": int(unit["begin"]), "dur": unit["total"]})
+            events += [{"name": x["name"], "cat": target, "ph": "X", "pid": pid, "tid": lane + 1,
+                        "ts": int(unit["begin"] + x["ts"]), "dur": x["dur"],
+                        "args": {"detail": x["detail"]} if x["detail"] else {}} for x in unit["events"]]
+
+    origin = min((x["ts"] for x in events if "ts" in x), default=0)
+    for x in events:
+        if "ts" in x:
+            x["ts"] -= origin
+    units.sort(key=lambda x: -x["total"])
+    with open(TIME_TRACE_REPORT_FILE, "w") as f:
+        json.dump({"targets": traced, "stages": stages,
+                   "units": [{k: v for k, v in x.items() if k not in ("events", "begin")} for x in units],
+                   "headers": dict(top_entries(headers)), "templates": dict(top_entries(templates))}, f, indent=2)
+    with open(TIME_TRACE_FILE, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    print_header("Slowest translation units (seconds, frontend / backend):")
+    for x in units[:TIME_TRACE_REPORT_LINES]:
+        print(f"{x['total'] / 1e6:8.2f}s {x['frontend'] / 1e6:8.2f} / {x['backend'] / 1e6:8.2f}  "
+              f"[{x['target']}] {x['name']}")
+    print_header("Most expensive headers (inclusive seconds, times parsed):")
+    for name, (dur, count) in top_entries(headers):
+        print(f"{dur / 1e6:8.2f}s {count:6}  {name}")
+    if templates:
+        print_header("Most expensive template instantiations (seconds, times):")
+        for name, (dur, count) in top_entries(templates):
+            print(f"{dur / 1e6:8.2f}s {count:6}  {name}")
+    print_header("Compiler stages (seconds over all units):")
+    for name, dur in sorted(stages.items(), key=lambda x: -x[1])[:TIME_TRACE_REPORT_LINES]:
+        print(f"{dur / 1e6:8.2f}s  {name}")
+    print_block(f"Report: {TIME_TRACE_REPORT_FILE}", f"Merged trace: {TIME_TRACE_FILE}")
+
+
+def clean_optimized_tree(target):
+    # Build trees survive between the instrumented and the final pass, and objects don't depend on flags
+    if optimized(target):
+        with phase("clean"):
+            if not fg("make", "clean"):
+                fail()
+
+
+def read_profile_info():
+    try:
+        with open(PGO_PROFILE_INFO_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def train_profile(instrumented_keys):
+    ffmpeg = ffmpeg_binary()
+    shutil.rmtree(PGO_RAW_DIR, ignore_errors=True)
+    mkdir(PGO_RAW_DIR)
+    print_header("Training the instrumented ffmpeg")
+    encoders = enabled_encoders(ffmpeg)
+    with phase("pgo-training", "pgo"):
+        with local.env(LLVM_PROFILE_FILE=pj(PGO_RAW_DIR, "ffmpeg-%p.profraw")):
+            for input_opts, output_opts in PGO_TRAINING_RUNS:
+                codec_flag = "-c:v" if "-c:v" in output_opts else "-c:a"
+                if output_opts[output_opts.index(codec_flag) + 1] not in encoders:
+                    # Lean profiles don't have every encoder
+                    continue
+                cmd = ("-hide_banner", "-nostdin", "-nostats", *input_opts, "-t", str(PGO_TRAINING_DURATION),
+                       *output_opts, "-f", "null", "-")
+                print(f"Training with: {' '.join(output_opts)}")
+                if not sfg(ffmpeg, *cmd):
+                    fail()
+    raw_files = sorted(pj(PGO_RAW_DIR, x) for x in os.listdir(PGO_RAW_DIR) if x.endswith(".profraw"))
+    if not raw_files:
+        print("Training produced no profile data, the ffmpeg binary is not instrumented")
+        fail()
+    with phase("pgo-merge", "pgo"):
+        if not sfg("llvm-profdata", "merge", f"--output={PGO_PROFILE_FILE}", *raw_files):
+            fail()
+    with open(PGO_PROFILE_INFO_FILE, "w") as f:
+        json.dump({"instrumented_keys": instrumented_keys, "sha256": file_sha256(PGO_PROFILE_FILE)}, f, indent=2)
+    print_block(f"Profile data merged from {len(raw_files)} runs: {PGO_PROFILE_FILE}")
+
+
+def build_optimized():
+    global PGO_STAGE
+    global PGO_PROFILE_SHA256
+
+    require_commands(*PGO_LLVM_COMMANDS)
+    if OS_TYPE != OS_TYPE_MAC:
+        require_commands("ld.lld")
+    if "ffmpeg" not in TARGETS:
+        print("Optimized build trains the profile on ffmpeg, so ffmpeg has to be among targets")
+        fail()
+
+    built = []
+    PGO_STAGE = PGO_STAGE_INSTRUMENT
+    compute_cache_keys()
+    instrumented_keys = {x: TARGET_KEYS[x] for x in OPTIMIZED_TARGETS if x in TARGET_KEYS}
+    profile_info = read_profile_info()
+    if fex(PGO_PROFILE_FILE) and profile_info is not None \
+            and profile_info.get("instrumented_keys") == instrumented_keys:
+        print_block(f"Profile data is up to date: {PGO_PROFILE_FILE}")
+    else:
+        print_block("Building instrumented targets to collect profile data")
+        try:
+            built += run_scheduler()
+            train_profile(instrumented_keys)
+        finally:
+            save_phase_records("pgo.phases.json")
+
+    PGO_STAGE = PGO_STAGE_USE
+    PGO_PROFILE_SHA256 = file_sha256(PGO_PROFILE_FILE)
+    reset_cache_keys()
+    print_block(f"Building optimized targets with profile {PGO_PROFILE_SHA256[:12]}")
+    built += run_scheduler()
+    return sorted(set(built))
+
+
+# Build graph
+# Targets are described as data: where the source comes from, how it's built, with which options, patches
+# and dependencies. Most of them are plain autoconf or CMake builds sharing one recipe, and only the odd ones
+# have a custom recipe. Since dependencies are known, independent targets can be built at the same time,
+# selected targets get their prerequisites, and a rebuild can be extended to everything that depends on it.
+# The global --jobs budget is split between targets that are running simultaneously.
+TARGET_REGISTRY = {}
+FORCED_TARGETS = set()
+DEFAULT_TARGETS = ("ffmpeg", "ffmpeg-msys2-deps")
+
+BUILD_SYSTEM_AUTOCONF = "autoconf"
+BUILD_SYSTEM_CMAKE = "cmake"
+BUILD_SYSTEM_CUSTOM = "custom"
+
+# Regex substitutions in a file of the source tree, or its removal, optionally for some operating systems only
+Patch = collections.namedtuple("Patch", ["file", "substitutions", "remove", "executable", "only_on"],
+                               defaults=((), False, False, None))
+
+FFMPEG_DEPENDENCIES = ("yasm", "nasm", "opencore", "libvpx", "lame", "opus", "xvidcore", "x264", "libogg",
+                       "libvorbis", "libtheora", "pkg-config", "vid_stab", "x265", "fdk_aac", "av1", "zlib",
+                       "openssl", "sdl")
+# Only linked with --slavery, free builds use gnutls and the native AAC encoder instead
+NONFREE_TARGETS = ("fdk_aac", "openssl")
+
+
+class Target:
+    def __init__(self, name, recipe=None, build_system=BUILD_SYSTEM_CUSTOM, deps=(), only_on=None, source=None,
+                 source_dir=(), build_dir=None, options=(), env=None, patches=(), post_install=None,
+                 memory=MEMORY_PER_JOB_DEFAULT, patch_queue=None, recipe_helpers=(), relocatable=True):
+        self.name = name
+        self.recipe = recipe
+        self.build_system = build_system
+        # Like options, may be a function: ffmpeg's deps depend on --profile and --freedom,
+        # which a worker changes for every request
+        self._deps = deps if callable(deps) else tuple(deps)
+        self.only_on = only_on
+        self.source = source
+        # Relative to WORK_DIR. CMake targets may be built out of tree in build_dir.
+        self.source_dir = tuple(source_dir)
+        self.build_dir = tuple(build_dir) if build_dir is not None else None
+        self.options = options
+        self.env = env
+        self.patches = tuple(patches)
+        self.post_install = post_install
+        # Megabytes per compile job
+        self.memory = memory
+        # Directory with our own patches for the source, relative to the checkout
+        self.patch_queue = patch_queue
+        # Functions and constants a custom recipe relies on, they are a part of the recipe for cache keys
+        self.recipe_helpers = tuple(recipe_helpers)
+        # False when the install prefix is compiled into binaries, where relocation can't patch it
+        self.relocatable = relocatable
+
+    @property
+    def deps(self):
+        return tuple(self._deps()) if callable(self._deps) else self._deps
+
+    def supported(self):
+        return self.only_on is None or OS_TYPE in self.only_on
+
+    def build(self):
+        if self.build_system == BUILD_SYSTEM_CUSTOM:
+            self.recipe()
+        else:
+            build_declared(self.name)
+
+
+def declare_target(name, build_system=BUILD_SYSTEM_AUTOCONF, **kwargs):
+    TARGET_REGISTRY[name] = Target(name, build_system=build_system, **kwargs)
+
+
+def build_target(name, **kwargs):
+    # Targets that don't fit into autoconf or CMake steps bring their own recipe
+    def register(recipe):
+        TARGET_REGISTRY[name] = Target(name, recipe=recipe, **kwargs)
+        return recipe
+
+    return register
+
+
+def target_env(target):
+    env = TARGET_REGISTRY[target].env
+    result = dict(env() if callable(env) else env or {})
+    result.update(optimization_env(target))
+    return result
+
+
+def apply_patches(target):
+    patches = [x for x in TARGET_REGISTRY[target].patches if x.only_on is None or OS_TYPE in x.only_on]
+    if not patches:
+        return
+    with phase("patch"):
+        for patch in patches:
+            path = pj(str(local.cwd), patch.file)
+            print(f"Patching {patch.file}")
+            if patch.remove:
+                rm(path)
+                continue
+            if patch.substitutions:
+                # Latin-1 maps every byte to a character, so files in any encoding survive the round trip
+                with open(path, encoding="latin-1") as f:
+                    content = f.read()
+                for pattern, replacement in patch.substitutions:
+                    content = re.sub(pattern, replacement, content)
+                with open(path, "w", encoding="latin-1") as f:
+                    f.write(content)
+            if patch.executable:
+                os.chmod(path, os.stat(path).st_mode | 0o111)
+
+
+def build_declared(target):
+    t = TARGET_REGISTRY[target]
+    download_source(target)
+    with target_cwd(*t.source_dir):
+        apply_patches(target)
+    if t.build_dir is not None:
+        mkdir(WORK_DIR, *t.build_dir)
+    with target_cwd(*(t.build_dir or t.source_dir)), local.env(**target_env(target)):
+        if t.build_system == BUILD_SYSTEM_CMAKE:
+            cmake(*target_options(target))
+        else:
+            configure(RELEASE_DIR, *target_options(target))
+        clean_optimized_tree(target)
+        make()
+        install()
+        if t.post_install is not None:
+            t.post_install()
+        mark_as_built(target)
+
+
+def dependency_closure(names):
+    result = set()
+
+    def visit(name):
+        if name in result or name not in TARGET_REGISTRY:
+            return
+        result.add(name)
+        for dep in TARGET_REGISTRY[name].deps:
+            if TARGET_REGISTRY[dep].supported():
+                visit(dep)
+
+    for x in names:
+        visit(x)
+    return [x for x in TARGET_REGISTRY if x in result]
+
+
+def reverse_dependencies(names):
+    result = set(names)
+    changed = True
+    while changed:
+        changed = False
+        for name, t in TARGET_REGISTRY.items():
+            if name not in result and any(dep in result for dep in t.deps):
+                result.add(name)
+                changed = True
+    return [x for x in TARGET_REGISTRY if x in result]
+
+
+def split_targets(value):
+    return [x for x in value.split(",") if x] if value else []
+
+
+def select_targets():
+    global TARGETS
+    # By default everything ffmpeg of the selected profile needs is built
+    requested = split_targets(args.targets) if args.targets is not None else dependency_closure(DEFAULT_TARGETS)
+    unknown = [x for x in requested + split_targets(args.rebuild) if x not in TARGET_REGISTRY]
+    if unknown:
+        print(f"Unknown targets will be ignored: {', '.join(unknown)}")
+    requested = [x for x in requested if x in TARGET_REGISTRY]
+    # Rebuilding a library means rebuilding everything linked with it as well, as far as it's selected
+    rebuild = [x for x in split_targets(args.rebuild) if x in TARGET_REGISTRY]
+    scope = set(dependency_closure(requested) if args.deps else requested)
+    FORCED_TARGETS.update(x for x in reverse_dependencies(rebuild) if x in rebuild or x in scope)
+    requested = requested + [x for x in FORCED_TARGETS if x not in requested]
+    if args.deps:
+        selected = dependency_closure(requested)
+        added = [x for x in selected if x not in requested]
+        if added:
+            print(f"Adding prerequisites of selected targets: {', '.join(added)}")
+    else:
+        selected = [x for x in TARGET_REGISTRY if x in requested]
+    excluded = split_targets(args.exclude_targets)
+    TARGETS = [x for x in selected if x not in excluded]
+
+
+def target_options(target):
+    # Options may depend on RELEASE_DIR, OS_TYPE or command line, so they can be given as a function
+    options = TARGET_REGISTRY[target].options
+    return tuple(options() if callable(options) else options)
+
+
+def fork_context():
+    # Recipes change plumbum's process-wide cwd and environment, so every parallel target needs its own process.
+    # Without fork (e.g. native Windows Python) we just fall back to building one target at a time.
+    import multiprocessing
+    if "fork" not in multiprocessing.get_all_start_methods():
+        return None
+    return multiprocessing.get_context("fork")
+
+
+def run_target(name, jobs, work_dir=TARGET_DIR, jobserver=None):
+    global JOBS
+    global CURRENT_TARGET
+    global WORK_DIR
+    global MAKE_JOBSERVER
+    JOBS = jobs
+    CURRENT_TARGET = name
+    WORK_DIR = work_dir
+    MAKE_JOBSERVER = jobserver
+    PHASE_RECORDS.clear()
+    try:
+        if name not in FORCED_TARGETS and (relink_stage_version(name) or restore_artifact(name)):
+            return
+        open_target_log(name)
+        reset_stage(name)
+        pathlib.Path(WORK_DIR).mkdir(parents=True, exist_ok=True)
+        for path in work_tree_dirs(name):
+            touch_cache_entry(path)
+        begin_compiler_cache_stats(name)
+        started = time.time()
+        try:
+            with local.env(**time_trace_env(name)):
+                TARGET_REGISTRY[name].build()
+        except BaseException:
+            rollback_stage(name)
+            raise
+        finally:
+            end_compiler_cache_stats(name)
+        if time_traced(name):
+            collect_time_traces(name, started)
+        save_work_tree_size(name)
+        if WORK_DIR != TARGET_DIR:
+            # Everything needed later is in the stage, and the memory is better used by the next target.
+            # A failed tree is kept for investigation.
+            shutil.rmtree(WORK_DIR, ignore_errors=True)
+    finally:
+        close_target_log()
+        save_phase_records(f"{name}.phases.json")
+
+
+# Distributed builds
+# With --workers the coordinator (a normal --build) hands targets to other hosts running this script
+# with --worker-listen (TCP) or --worker (stdin/stdout, started over ssh). A worker gets the artifacts
+# of all dependencies of a target, installs them into its own empty release, builds the target and sends back
+# its stage as an artifact, which the coordinator relocates and publishes as if it was restored from the cache.
+# Every worker builds one target at a time with all of its CPUs, and the coordinator keeps building locally,
+# so independent targets run on separate hosts and a cold build takes roughly the critical path.
+# Workers build in their own worker/ directory of the checkout, its release is replaced for every request.
+#
+# ssh:// workers are authenticated by ssh. A TCP worker listens on 127.0.0.1 unless it's given a host, and on
+# anything else it needs a shared token. With a token the worker and the coordinator prove to each other
+# that they know it (HMAC of a random challenge) before anything else is sent, the token itself never is.
+#
+# The protocol is a JSON line followed by a binary payload of the given size:
+# -> {"command": "build", "target", "builder", "slavery", "profile", "deps": [{"target", "size"}, ...]} + artifacts
+# <- {"status": "ok", "size"} + artifact, or {"status": "failed", "error", "tail": [lines of the log]}
+REMOTE_DIR = pj(TARGET_DIR, "remote")
+# ffmpeg is linked here: it's the last target anyway, and its result is what we are running the build for
+LOCAL_ONLY_TARGETS = ("ffmpeg", "ffmpeg-msys2-deps")
+# Exit code of a remote target that should be built somewhere else: the worker is down or runs another builder
+WORKER_UNAVAILABLE = 75
+WORKER_TIMEOUT = 60
+WORKER_TOKEN_ENV = "FFMPEG_BUILDER_WORKER_TOKEN"
+WORKER_DEFAULT_HOST = "127.0.0.1"
+LOOPBACK_HOSTS = ("127.0.0.1", "::1", "localhost")
+
+
+def worker_token():
+    if args.worker_token_file is not None:
+        with open(args.worker_token_file) as f:
+            return f.read().strip() or None
+    return os.environ.get(WORKER_TOKEN_ENV) or None
+
+
+def token_proof(token, role, challenge):
+    return hmac.new(token.encode(), f"{role}:{challenge}".encode(), hashlib.sha256).hexdigest()
+
+
+def authenticate_worker(stream, token):
+    # Coordinator side, right after connecting
+    challenge = read_message(stream).get("challenge")
+    if challenge is None:
+        if token is not None:
+            raise ValueError("the worker doesn't check tokens, start it with --worker-token-file")
+        return
+    if token is None:
+        raise ValueError("the worker needs a token, use --worker-token-file")
+    own_challenge = secrets.token_hex(16)
+    send_message(stream, {"command": "auth", "proof": token_proof(token, "coordinator", challenge),
+                          "challenge": own_challenge})
+    response = read_message(stream)
+    if response.get("status") != "ok":
+        raise ValueError(response.get("error", "authentication failed"))
+    if not hmac.compare_digest(str(response.get("proof")), token_proof(token, "worker", own_challenge)):
+        raise ValueError("the worker doesn't know our token")
+
+
+def authenticate_coordinator(stream, token):
+    # Worker side, before reading any request
+    if token is None:
+        send_message(stream, {"challenge": None})
+        return True
+    challenge = secrets.token_hex(16)
+    send_message(stream, {"challenge": challenge})
+    try:
+        request = read_message(stream)
+    except (EOFError, ValueError):
+        return False
+    if request.get("command") != "auth" or \
+            not hmac.compare_digest(str(request.get("proof")), token_proof(token, "coordinator", challenge)):
+        send_message(stream, {"status": "failed", "error": "authentication failed"})
+        return False
+    send_message(stream, {"status": "ok", "proof": token_proof(token, "worker", str(request.get("challenge")))})
+    return True
+
+
+def builder_hash():
+    # Recipes and options live in this file, so a worker has to run exactly the same one
+    with open(os.path.abspath(__file__), "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def worker_addresses():
+    return split_targets(args.workers)
+
+
+def distributable(target):
+    # A worker would compile its own prefix into a target that isn't relocatable
+    return target not in LOCAL_ONLY_TARGETS and TARGET_REGISTRY[target].relocatable and \
+        not optimized(target) and not time_traced(target)
+
+
+def send_message(stream, header, payload_files=()):
+    stream.write((json.dumps(header) + "\n").encode())
+    for path in payload_files:
+        with open(path, "rb") as f:
+            shutil.copyfileobj(f, stream)
+    stream.flush()
+
+
+def read_message(stream):
+    line = stream.readline()
+    if not line:
+        raise EOFError("Connection closed")
+    return json.loads(line)
+
+
+def read_payload(stream, size, path):
+    with open(path, "wb") as f:
+        while size > 0:
+            chunk = stream.read(min(size, DOWNLOAD_CHUNK_SIZE))
+            if not chunk:
+                raise EOFError("Connection closed in the middle of an artifact")
+            f.write(chunk)
+            size -= len(chunk)
+
+
+class ReadWriteStream:
+    # Sockets and pipes of ssh or our own stdio look the same to the protocol
+    def __init__(self, rfile, wfile):
+        self.rfile = rfile
+        self.wfile = wfile
+
+    def write(self, data):
+        self.wfile.write(data)
+
+    def flush(self):
+        self.wfile.flush()
+
+    def readline(self):
+        return self.rfile.readline()
+
+    def read(self, size):
+        return self.rfile.read(size)
+
+
+@contextlib.contextmanager
+def connect_worker(address):
+    if address.startswith("tcp://"):
+        host, _, port = address[len("tcp://"):].rpartition(":")
+        with socket.create_connection((host.strip("[]"), int(port)), timeout=WORKER_TIMEOUT) as connection:
+            # Builds take much longer than any sane timeout, so it's only used to connect
+            connection.settimeout(None)
+            with connection.makefile("rb") as rfile, connection.makefile("wb") as wfile:
+                stream = ReadWriteStream(rfile, wfile)
+                authenticate_worker(stream, worker_token())
+                yield stream
+    elif address.startswith("ssh://"):
+        host, _, path = address[len("ssh://"):].partition("/")
+        command = f"cd /{path} && python3 ./ffmpeg-builder.py --worker --silent"
+        with subprocess.Popen(["ssh", "-o", "BatchMode=yes", "-o", f"ConnectTimeout={WORKER_TIMEOUT}", host,
+                               command], stdin=subprocess.PIPE, stdout=subprocess.PIPE) as process:
+            try:
+                yield ReadWriteStream(process.stdout, process.stdin)
+            finally:
+                process.stdin.close()
+    else:
+        raise ValueError(f"Unknown worker address: {address}, expected tcp://host:port or ssh://host/path")
+
+
+def dependency_artifact(target):
+    # Packed once per key, the same dependencies are sent to every worker
+    path = pj(REMOTE_DIR, artifact_name(target))
+    if not fex(path):
+        if not staged_files(target):
+            raise OSError(f"Stage of {target} is empty, rebuild it with --rebuild {target}")
+        temp_path = f"{path}.{os.getpid()}.part"
+        pack_artifact(target, temp_path)
+        os.replace(temp_path, path)
+    return path
+
+
+def run_remote_target(name, address):
+    global CURRENT_TARGET
+    CURRENT_TARGET = name
+    PHASE_RECORDS.clear()
+    deps = [x for x in dependency_closure([name]) if x != name and TARGET_REGISTRY[x].supported()]
+    artifact_file = pj(REMOTE_DIR, f"{artifact_name(name)}.{os.getpid()}.part")
+    try:
+        if name not in FORCED_TARGETS and relink_stage_version(name):
+            return
+        mkdir(REMOTE_DIR)
+        with phase("remote"):
+            dep_files = [dependency_artifact(x) for x in deps]
+            request = {"command": "build", "target": name, "builder": builder_hash(),
+                       "slavery": args.slavery_mode, "profile": args.profile,
+                       "deps": [{"target": x, "size": os.path.getsize(path)} for x, path in zip(deps, dep_files)]}
+            with connect_worker(address) as stream:
+                send_message(stream, request, dep_files)
+                response = read_message(stream)
+                if response["status"] == "ok":
+                    read_payload(stream, response["size"], artifact_file)
+        if response["status"] != "ok":
+            print_header(f"[{name}] Failed on {address}: {response['error']}")
+            print_lines(*(f"[{name}] {line}" for line in response.get("tail", [])))
+            sys.exit(WORKER_UNAVAILABLE if response.get("retry") else 1)
+        with phase("restore"):
+            unpack_artifact(name, artifact_file)
+        mark_as_built(name)
+    except (OSError, EOFError, ValueError, KeyError, tarfile.TarError) as e:
+        print(f"Worker {address} is not available for {name}: {e}")
+        sys.exit(WORKER_UNAVAILABLE)
+    finally:
+        if fex(artifact_file):
+            os.remove(artifact_file)
+        save_phase_records(f"{name}.phases.json")
+
+
+def log_tail(target):
+    try:
+        with gzip.open(log_file_name(target), "rt", encoding="utf-8", errors="replace") as f:
+            return list(collections.deque(f.read().splitlines(), maxlen=args.log_tail))
+    except OSError:
+        return []
+
+
+def serve_build(request, stream):
+    name = request["target"]
+    if request.get("builder") != builder_hash():
+        return {"status": "failed", "error": "the worker runs another version of ffmpeg-builder.py", "retry": True}
+    if name not in TARGET_REGISTRY or not TARGET_REGISTRY[name].supported():
+        return {"status": "failed", "error": f"{name} can't be built on {platform.node()}", "retry": True}
+    print_header(f"Building {name} for a coordinator")
+    args.slavery_mode = request["slavery"]
+    args.profile = request["profile"]
+
+    # Only the dependencies we got may be installed, anything left from an earlier request could be picked up
+    shutil.rmtree(RELEASE_DIR, ignore_errors=True)
+    mkdirs(RELEASE_DIR, REMOTE_DIR)
+    with tempfile.TemporaryDirectory(dir=REMOTE_DIR) as temp_dir:
+        for dep in request["deps"]:
+            path = pj(temp_dir, f"{dep['target']}.tar.gz")
+            read_payload(stream, dep["size"], path)
+            unpack_artifact(dep["target"], path)
+            publish_stage(dep["target"])
+        reset_cache_keys()
+        compute_cache_keys()
+        FORCED_TARGETS.add(name)
+
+        ctx = fork_context()
+        if ctx is None:
+            try:
+                run_target(name, JOBS)
+                exitcode = 0
+            except SystemExit as e:
+                exitcode = e.code
+        else:
+            process = ctx.Process(target=run_target, args=(name, JOBS), name=name)
+            process.start()
+            process.join()
+            exitcode = process.exitcode
+        if exitcode != 0:
+            print(f"Target {name} failed with exit code {exitcode}")
+            return {"status": "failed", "error": f"exit code {exitcode} on {platform.node()}",
+                    "tail": log_tail(name)}
+
+        artifact_file = pj(temp_dir, f"{name}.tar.gz")
+        pack_artifact(name, artifact_file)
+        send_message(stream, {"status": "ok", "size": os.path.getsize(artifact_file)}, (artifact_file,))
+        print(f"Target {name} sent to the coordinator")
+    return None
+
+
+def serve_coordinator(stream):
+    while True:
+        try:
+            request = read_message(stream)
+        except EOFError:
+            return
+        if request.get("command") != "build":
+            send_message(stream, {"status": "failed", "error": f"unknown command {request.get('command')}"})
+            continue
+        try:
+            response = serve_build(request, stream)
+        except (OSError, EOFError, ValueError, KeyError, tarfile.TarError) as e:
+            # The rest of the request may still be in the stream, so the connection can't be used anymore
+            print(f"Failed to serve the coordinator: {e}")
+            send_message(stream, {"status": "failed", "error": f"{platform.node()}: {e}", "retry": True})
+            return
+        if response is not None:
+            send_message(stream, response)
+
+
+class WorkerRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        stream = ReadWriteStream(self.rfile, self.wfile)
+        # The worker serves one connection at a time, nobody may hold it without a token
+        self.connection.settimeout(WORKER_TIMEOUT)
+        try:
+            authenticated = authenticate_coordinator(stream, self.server.token)
+        except OSError:
+            authenticated = False
+        if not authenticated:
+            print(f"Rejected a coordinator from {self.client_address[0]}: wrong token")
+            return
+        self.connection.settimeout(None)
+        print(f"Coordinator connected from {self.client_address[0]}")
+        serve_coordinator(stream)
+
+
+class WorkerServer(socketserver.TCPServer):
+    # A restarted worker shouldn't wait for the old socket to time out
+    allow_reuse_address = True
+    token = None
+
+
+class WorkerServer6(WorkerServer):
+    address_family = socket.AF_INET6
+
+
+def run_worker():
+    if args.worker_mode:
+        # stdout belongs to the protocol, everything we and our children print goes to stderr instead
+        stream = ReadWriteStream(os.fdopen(os.dup(0), "rb"), os.fdopen(os.dup(1), "wb"))
+        os.dup2(2, 1)
+        sys.stdout = sys.stderr
+    print_header(f"Worker {platform.node()} started")
+    mkdirs(TARGET_DIR, RELEASE_DIR, DOWNLOAD_CACHE_DIR)
     push_path(RELEASE_BIN_DIR)
-    require_commands("make", "g++", "curl", "tar")
+    require_commands("make", "g++")
     set_jobs_num()
+    setup_compiler_cache()
+    if args.worker_mode:
+        serve_coordinator(stream)
+        return
+    host, _, port = args.worker_listen.rpartition(":")
+    host = host.strip("[]") or WORKER_DEFAULT_HOST
+    token = worker_token()
+    if token is None and host not in LOOPBACK_HOSTS:
+        print_p(f"Anybody who can reach {host}:{port} could run builds here and send artifacts to coordinators.",
+                f"Give workers and coordinators a shared secret with --worker-token-file "
+                f"(or {WORKER_TOKEN_ENV}), or use ssh:// workers")
+        fail()
+    # One coordinator at a time, a worker uses all of its jobs for one target
+    server_class = WorkerServer6 if ":" in host else WorkerServer
+    with server_class((host, int(port)), WorkerRequestHandler) as server:
+        server.token = token
+        print_block(f"Listening on {host}:{port}" + (", coordinators need the token" if token is not None else ""))
+        server.serve_forever()
+
+
+# Shared make jobserver
+# A target gets its share of --jobs when it starts, and with its own -j it would keep that share to the end:
+# a target started in a wide wave keeps 1-2 jobs after its neighbours finish, while ffmpeg or x265 could use
+# all of the idle CPUs. So parallel targets run make as clients of one GNU make jobserver with --jobs slots,
+# and free slots go to whoever is compiling right now. Every make has one implicit slot of its own,
+# so the scheduler takes a token out of the pool for each running target and returns it when the target ends.
+# The pool is a FIFO: makes read it as usual, and the scheduler opens it once more without blocking.
+# A target that would run out of memory with all of the slots keeps its own -j.
+MAKE_JOBSERVER_FIFO = pj(TARGET_DIR, "jobserver.fifo")
+MAKE_JOBSERVER = None
+
+
+def jobserver_makeflags(fd):
+    # --jobserver-fds for make 3.81 (MacOS), --jobserver-auth for make 4.2+
+    return f"-j --jobserver-fds={fd},{fd} --jobserver-auth={fd},{fd}"
+
+
+def start_jobserver(jobs):
+    global MAKE_JOBSERVER
+    if not hasattr(os, "mkfifo") or jobs < 2:
+        return None
+    if os.path.lexists(MAKE_JOBSERVER_FIFO):
+        os.remove(MAKE_JOBSERVER_FIFO)
+    os.mkfifo(MAKE_JOBSERVER_FIFO)
+    MAKE_JOBSERVER = os.open(MAKE_JOBSERVER_FIFO, os.O_RDWR)
+    pool = os.open(MAKE_JOBSERVER_FIFO, os.O_RDWR | os.O_NONBLOCK)
+    os.write(pool, b"+" * jobs)
+    return pool
+
+
+def take_job_token(pool):
+    # All tokens may be taken by makes at the moment, then the target just runs one job over the limit
+    try:
+        return len(os.read(pool, 1)) == 1
+    except BlockingIOError:
+        return False
 
-    if need_building("yasm"):
-        download("http://www.tortall.net/projects/yasm/releases/yasm-1.3.0.tar.gz",
-                 "yasm-1.3.0.tar.gz")
-        with target_cwd("yasm-1.3.0"):
-            configure(RELEASE_DIR)
-            make()
-            install()
-            mark_as_built("yasm")
 
-    if need_building("nasm"):
-        download("https://www.nasm.us/pub/nasm/releasebuilds/2.14.02/nasm-2.14.02.tar.gz",
-                 "nasm.tar.gz")
-        with target_cwd("nasm-2.14.02"):
-            configure(RELEASE_DIR, "--disable-shared", "--enable-static")
-            make()
-            install()
-            mark_as_built("nasm")
-
-    if need_building("opencore"):
-        download(
-            "http://downloads.sourceforge.net/project/opencore-amr/opencore-amr/opencore-amr-0.1.5.tar.gz?r=http%3A%2F%2Fsourceforge.net%2Fprojects%2Fopencore-amr%2Ffiles%2Fopencore-amr%2F&ts=1442256558&use_mirror=netassist",
-            "opencore-amr-0.1.5.tar.gz")
-        with target_cwd("opencore-amr-0.1.5"):
-            configure(RELEASE_DIR, "--disable-shared", "--enable-static")
-            make()
-            install()
-            mark_as_built("opencore")
-
-    if need_building("libvpx"):
-        download("https://github.com/webmproject/libvpx/archive/v1.8.1.tar.gz",
-                 "libvpx-1.8.1.tar.gz")
-        with target_cwd("libvpx-1.8.1"):
-            if OS_TYPE == OS_TYPE_MAC:
-                print("Patching libvpx for MacOS")
-                ((local["sed"]["s/,--version-script//g", "build/make/Makefile"]) > "build/make/Makefile.patched")()
-                ((local["sed"]["s/-Wl,--no-undefined -Wl,-soname/-Wl,-undefined,error -Wl,-install_name/g",
-                               "build/make/Makefile.patched"]) > "build/make/Makefile")()
-            configure(RELEASE_DIR, "--disable-shared", "--disable-unit-tests")
-            make()
-            install()
-            mark_as_built("libvpx")
-
-    if need_building("lame"):
-        # First attempt was to use lame-3.100:
-        # http://kent.dl.sourceforge.net/project/lame/lame/3.100/lame-3.100.tar.gz
-        # But old version 3.100 breaks Windows compatibility when using libiconv
-        # since frontend/parse.c now depends on langinfo.h.
-        # https://github.com/bincrafters/community/issues/480
-        #
-        # We have option to use the latest snapshot from SVN:
-        # https://sourceforge.net/p/lame/svn/HEAD/tarball
-        # https://sourceforge.net/code-snapshots/svn/l/la/lame/svn/lame-svn-r6449-trunk.zip
-        # And get the exact version with: https://sourceforge.net/projects/lame/best_release.json
-        #
-        # But for now I just imported everything into OpenStreamCaster's space on GitHub:
-        # https://codeload.github.com/openstreamcaster/lame/zip/master
-
-        download("https://codeload.github.com/openstreamcaster/lame/zip/master",
-                 "lame-master.zip", alter_name=None, archive_format=ARCHIVE_FORMAT_ZIP)
-        with target_cwd("lame-master"):
-            configure(RELEASE_DIR, "--disable-shared", "--enable-static")
-            fg("chmod", "+x", "install-sh")
-            make()
-            install()
-            mark_as_built("lame")
-
-    if need_building("opus"):
-        download("https://archive.mozilla.org/pub/opus/opus-1.3.1.tar.gz",
-                 "opus-1.3.1.tar.gz")
-        with target_cwd("opus-1.3.1"):
+def stop_jobserver(pool):
+    global MAKE_JOBSERVER
+    if pool is None:
+        return
+    os.close(pool)
+    os.close(MAKE_JOBSERVER)
+    MAKE_JOBSERVER = None
+    os.remove(MAKE_JOBSERVER_FIFO)
+
+
+def ready_targets(pending, scheduled, done):
+    result = []
+    for name in pending:
+        deps = TARGET_REGISTRY[name].deps
+        if all((dep not in scheduled) or (dep in done) for dep in deps):
+            result.append(name)
+    return result
 
-            # On Windows, there's a huge problem.
-            # "Unlike glibc, mingw-w64 does not provide fortified functions at all...
-            # "... actually it does now, but its broken as hell :S"
-            #
-            # MinGW: https://github.com/msys2/MINGW-packages/issues/5803
-            # Opus: https://github.com/bincrafters/community/issues/1077
-            #
-            # Solution:
-            # Fortification requires -lssp (or -fstack-protector which adds -lssp implicitly) to work.
 
-            old_ldflags = local.env.get("LDFLAGS")
-            if OS_TYPE == OS_TYPE_WINDOWS:
-                if old_ldflags is not None:
-                    local.env["LDFLAGS"] = f"{old_ldflags} -fstack-protector"
+def run_scheduler(fetch_only=False):
+    if fetch_only:
+        pending = []
+        selected = [name for name, t in TARGET_REGISTRY.items() if t.supported() and name in TARGETS]
+    else:
+        compute_cache_keys()
+        pending = [name for name, t in TARGET_REGISTRY.items() if t.supported() and need_building(name)]
+        selected = pending
+    scheduled = set(pending)
+    done = set()
+    failed = []
+    running = {}
+    free_jobs = max(1, int(JOBS))
+    free_memory = available_memory() if not fetch_only else None
+    free_tmpfs = tmpfs_free() if not fetch_only else None
+    if args.tmpfs_dir is not None and not fetch_only and free_tmpfs is None:
+        print_block(f"{args.tmpfs_dir} is not available, building on disk")
+    history = read_build_history().get(platform.node(), {})
+    waiting_for_memory = False
+
+    ctx = fork_context()
+    if ctx is None:
+        print_block("Parallel building is not available on this platform, building targets one by one")
+
+    # Targets given to a worker are downloaded there
+    free_workers = worker_addresses() if ctx is not None and not fetch_only else []
+    remote = {}
+
+    # Archives are prefetched by a small pool of download processes while earlier targets are compiling.
+    # A target is started only when its own archive is ready, so nobody waits for unrelated downloads.
+    to_fetch = []
+    if ctx is not None and (args.prefetch or fetch_only):
+        to_fetch = [name for name in selected if need_fetching(name) and not (free_workers and distributable(name))]
+    fetching = {}
+    fetched = set(selected) - set(to_fetch)
+
+    # Without parallel targets every make gets all of the jobs anyway
+    pool = start_jobserver(int(JOBS)) if ctx is not None and not fetch_only and args.max_parallel_targets != 1 \
+        else None
+    memory_budget = free_memory
+    tokens = set()
+    try:
+        while pending or running or fetching or to_fetch:
+            while to_fetch and len(fetching) < max(1, args.download_workers):
+                name = to_fetch.pop(0)
+                # Targets built in tmpfs are extracted there, and --fetch-only doesn't need source trees at all
+                process = ctx.Process(target=prefetch_target, args=(name, not fetch_only and free_tmpfs is None),
+                                      name=f"fetch-{name}")
+                process.start()
+                fetching[name] = process
+
+            was_waiting_for_memory, waiting_for_memory = waiting_for_memory, False
+            if not failed:
+                for name in [x for x in ready_targets(pending, scheduled, done) if distributable(x)]:
+                    if not free_workers:
+                        break
+                    address = free_workers.pop(0)
+                    pending.remove(name)
+                    print(f"Starting target {name} on {address}")
+                    process = ctx.Process(target=run_remote_target, args=(name, address), name=name)
+                    process.start()
+                    running[name] = (process, 0, 0, 0)
+                    remote[name] = address
+
+                ready = [x for x in ready_targets(pending, scheduled, done) if x in fetched]
+                for name in ready:
+                    if free_jobs < 1:
+                        break
+                    if args.max_parallel_targets is not None and len(running) >= args.max_parallel_targets:
+                        break
+                    jobs = max(1, free_jobs // (len(ready) - ready.index(name)))
+                    memory = 0
+                    if free_memory is not None:
+                        # A target that doesn't fit waits for others to finish,
+                        # but alone it always gets at least one job
+                        weight = TARGET_REGISTRY[name].memory
+                        if free_memory < weight and running:
+                            waiting_for_memory = True
+                            break
+                        jobs = max(1, min(jobs, free_memory // weight))
+                        memory = jobs * weight
+                    if running:
+                        pressure = memory_pressure()
+                        if pressure is not None and pressure > MEMORY_PRESSURE_LIMIT:
+                            if not was_waiting_for_memory:
+                                print(f"Memory pressure is {pressure}%, not starting new targets for now")
+                            waiting_for_memory = True
+                            break
+                    work_dir = TARGET_DIR
+                    if free_tmpfs is not None:
+                        tree = work_tree_estimate(name, history)
+                        if tree <= free_tmpfs and (free_memory is None or tree <= free_memory - memory):
+                            work_dir = tmpfs_work_dir(name)
+                            free_tmpfs -= tree
+                            memory += tree
+                        else:
+                            print(f"Work tree of {name} (~{tree} MB) doesn't fit into memory, building on disk")
+                    free_jobs -= jobs
+                    if free_memory is not None:
+                        free_memory -= memory
+                    pending.remove(name)
+                    shared = pool is not None and (memory_budget is None or
+                                                   int(JOBS) * TARGET_REGISTRY[name].memory <= memory_budget)
+                    print(f"Starting target {name} " +
+                          ("on the shared jobserver" if shared else f"with {jobs} jobs") +
+                          (f" in {work_dir}" if work_dir != TARGET_DIR else ""))
+                    if ctx is None:
+                        try:
+                            run_target(name, jobs, work_dir)
+                        except SystemExit:
+                            failed.append(name)
+                        else:
+                            done.add(name)
+                        free_jobs += jobs
+                        if free_memory is not None:
+                            free_memory += memory
+                        if work_dir != TARGET_DIR:
+                            free_tmpfs += tree
+                        continue
+                    if shared and take_job_token(pool):
+                        tokens.add(name)
+                    process = ctx.Process(target=run_target, args=(name, jobs, work_dir,
+                                                                   MAKE_JOBSERVER if shared else None), name=name)
+                    process.start()
+                    running[name] = (process, jobs, memory, tree if work_dir != TARGET_DIR else 0)
+
+            if not running and not fetching:
+                if failed or not pending:
+                    break
+                if not ready_targets(pending, scheduled, done):
+                    print(f"Dependency cycle detected between: {', '.join(pending)}")
+                    fail()
+                continue
+
+            from multiprocessing.connection import wait
+            sentinels = [process.sentinel for process, _, _, _ in running.values()]
+            sentinels += [process.sentinel for process in fetching.values()]
+            # Pressure goes down without any process finishing, so it has to be polled
+            finished = wait(sentinels, timeout=MEMORY_PRESSURE_POLL_INTERVAL if waiting_for_memory else None)
+            for name, process in list(fetching.items()):
+                if process.sentinel not in finished:
+                    continue
+                process.join()
+                del fetching[name]
+                if process.exitcode == 0:
+                    fetched.add(name)
+                else:
+                    print(f"Download for target {name} failed")
+                    failed.append(name)
+                    if name in pending:
+                        pending.remove(name)
+                    to_fetch.clear()
+            for name, (process, jobs, memory, tree) in list(running.items()):
+                if process.sentinel not in finished:
+                    continue
+                process.join()
+                del running[name]
+                free_jobs += jobs
+                if free_memory is not None:
+                    free_memory += memory
+                if free_tmpfs is not None:
+                    free_tmpfs += tree
+                if name in tokens:
+                    tokens.remove(name)
+                    os.write(pool, b"+")
+                address = remote.pop(name, None)
+                if address is not None and process.exitcode == WORKER_UNAVAILABLE:
+                    # Built here or by another worker then, this one won't get anything else
+                    print(f"Worker {address} dropped, target {name} is scheduled again")
+                    pending.append(name)
+                    fetched.add(name)
+                    continue
+                if address is not None:
+                    free_workers.append(address)
+                if process.exitcode == 0:
+                    print(f"Target {name} finished")
+                    done.add(name)
                 else:
-                    local.env["LDFLAGS"] = " -fstack-protector"
+                    print(f"Target {name} failed with exit code {process.exitcode}")
+                    failed.append(name)
+                    to_fetch.clear()
+    finally:
+        stop_jobserver(pool)
+
+    if failed:
+        print_block(f"Failed targets: {', '.join(failed)}",
+                    f"Not started: {', '.join(pending)}" if pending else "Everything else was finished")
+        fail()
+    if fetch_only:
+        print_block(f"Fetched archives for: {', '.join(selected) if selected else 'nothing'}")
+        return
+    print_block(f"Built targets: {', '.join(sorted(done)) if done else 'nothing, everything is cached'}")
+    return sorted(done)
+
+
+# Build plan
+# --plan shows what --build would do without doing anything: which targets are stale and why, in which waves
+# they can run, and how long it should take according to earlier builds on this host. It only reads stamps and
+# stats files, so it's done in a blink.
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+def stale_reason(target):
+    if target in FORCED_TARGETS:
+        return "rebuild requested"
+    changed = stale_inputs(target)
+    if changed is None:
+        return "never built"
+    if not changed:
+        return None
+    return f"{', '.join(changed)} changed"
+
+
+def print_plan():
+    global PGO_STAGE
+    global PGO_PROFILE_SHA256
+
+    started = time.time()
+    if args.optimized_mode:
+        # The final pass is planned if there is a profile, otherwise the instrumented one
+        profile_info = read_profile_info()
+        if fex(PGO_PROFILE_FILE) and profile_info is not None:
+            PGO_STAGE, PGO_PROFILE_SHA256 = PGO_STAGE_USE, profile_info.get("sha256")
+        else:
+            PGO_STAGE = PGO_STAGE_INSTRUMENT
+    compute_cache_keys()
+    history = read_build_history().get(platform.node(), {})
+    # Only a local artifact cache is checked, asking an HTTP one about every target is not instant
+    local_cache = args.artifact_cache is not None and not is_http_url(args.artifact_cache)
+
+    stale = {}
+    estimates = {}
+    print_header("Plan:")
+    for name, t in TARGET_REGISTRY.items():
+        if name not in TARGETS or not t.supported():
+            continue
+        reason = stale_reason(name)
+        if reason is None:
+            print(f"{name:>20}: cached")
+            continue
+        stale[name] = reason
+        runs = history.get(name, [])
+        if local_cache and name not in FORCED_TARGETS and artifact_available(name):
+            estimates[name] = 0.0
+            reason = f"{reason}, restore from artifact"
+        elif runs:
+            estimates[name] = median(x["wall"] for x in runs)
+        estimate = f"~{format_duration(estimates[name])}" if name in estimates else "no history"
+        print(f"{name:>20}: {reason}, {estimate}")
+    print_block()
 
-            configure(RELEASE_DIR, "--disable-shared", "--enable-static")
-            make()
+    if not stale:
+        print_block("Nothing to build, everything is cached", f"Planned in {time.time() - started:.2f}s")
+        return
 
-            # Restore old LDFLAGS after all that dark magic
-            if (OS_TYPE == OS_TYPE_WINDOWS) and (old_ldflags is not None):
-                local.env["LDFLAGS"] = old_ldflags
+    waves = {}
+    finish = {}
+    longest_dep = {}
+
+    def wave_of(name):
+        if name not in waves:
+            waves[name] = 1 + max([wave_of(x) for x in TARGET_REGISTRY[name].deps if x in stale] or [0])
+        return waves[name]
+
+    def path_length(name):
+        # Targets without history count as 0s, so equal estimates are told apart by the longest dependency chain
+        return finish_of(name), wave_of(name)
+
+    def finish_of(name):
+        if name not in finish:
+            deps = [x for x in TARGET_REGISTRY[name].deps if x in stale]
+            longest_dep[name] = max(deps, key=path_length) if deps else None
+            before = finish_of(longest_dep[name]) if longest_dep[name] is not None else 0.0
+            finish[name] = before + estimates.get(name, 0.0)
+        return finish[name]
+
+    for name in stale:
+        wave_of(name)
+        finish_of(name)
+    print_header("Waves (targets of a wave can run at the same time):")
+    for wave in range(1, max(waves.values()) + 1):
+        print(f"{wave:>20}: {', '.join(x for x in stale if waves[x] == wave)}")
+    print_block()
 
-            install()
-            mark_as_built("opus")
+    last = max(stale, key=path_length)
+    critical_path = []
+    while last is not None:
+        critical_path.insert(0, last)
+        last = longest_dep[last]
+    unknown = [x for x in stale if x not in estimates]
+    # Targets running side by side share --jobs, so the real duration lies between these two numbers
+    print_block(f"Critical path: {' -> '.join(critical_path)}" if estimates else
+                f"Critical path: unknown, the longest dependency chain is {' -> '.join(critical_path)}",
+                f"Estimated duration: {format_duration(finish[critical_path[-1]])} with enough jobs for every wave, "
+                f"{format_duration(sum(estimates.values()))} one target at a time",
+                f"No history (counted as 0): {', '.join(unknown)}" if unknown else "Every stale target has history",
+                f"Planned in {time.time() - started:.2f}s")
+
+
+# Releases are pinned by SHA-256. Snapshots of moving branches (x264 stable, lame master, Windows deps)
+# and archives generated on the fly by gitweb and gitiles (ffmpeg, aom) change with every download or
+# regeneration, so they are trusted on first use.
+declare_target("yasm",
+               source=Source("http://www.tortall.net/projects/yasm/releases/yasm-1.3.0.tar.gz",
+                             "yasm-1.3.0.tar.gz",
+                             sha256="3dce6601b495f5b3d45b59f7d2492a340ee7e84b5beca17e48f862502bd5603f"),
+               source_dir=("yasm-1.3.0",))
+
+declare_target("nasm",
+               options=("--disable-shared", "--enable-static"),
+               source=Source("https://www.nasm.us/pub/nasm/releasebuilds/2.14.02/nasm-2.14.02.tar.gz",
+                             "nasm.tar.gz",
+                             sha256="b34bae344a3f2ed93b2ca7bf25f1ed3fb12da89eeda6096e3551fd66adeae9fc"),
+               source_dir=("nasm-2.14.02",))
+
+declare_target("opencore",
+               options=("--disable-shared", "--enable-static"),
+               source=Source("http://downloads.sourceforge.net/project/opencore-amr/opencore-amr/opencore-amr-0.1.5.tar.gz?r=http%3A%2F%2Fsourceforge.net%2Fprojects%2Fopencore-amr%2Ffiles%2Fopencore-amr%2F&ts=1442256558&use_mirror=netassist",
+                             "opencore-amr-0.1.5.tar.gz",
+                             sha256="2c006cb9d5f651bfb5e60156dbff6af3c9d35c7bbcc9015308c0aff1e14cd341"),
+               source_dir=("opencore-amr-0.1.5",))
+
+declare_target("libvpx", deps=("yasm", "nasm"),
+               options=("--disable-shared", "--disable-unit-tests"),
+               source=Source("https://github.com/webmproject/libvpx/archive/v1.8.1.tar.gz",
+                             "libvpx-1.8.1.tar.gz",
+                             sha256="df19b8f24758e90640e1ab228ab4a4676ec3df19d23e4593375e6f3847dee03e"),
+               source_dir=("libvpx-1.8.1",),
+               patches=(Patch("build/make/Makefile",
+                              ((",--version-script", ""),
+                               ("-Wl,--no-undefined -Wl,-soname", "-Wl,-undefined,error -Wl,-install_name")),
+                              only_on=(OS_TYPE_MAC,)),))
+
+# First attempt was to use lame-3.100:
+# http://kent.dl.sourceforge.net/project/lame/lame/3.100/lame-3.100.tar.gz
+# But old version 3.100 breaks Windows compatibility when using libiconv
+# since frontend/parse.c now depends on langinfo.h.
+# https://github.com/bincrafters/community/issues/480
+#
+# We have option to use the latest snapshot from SVN:
+# https://sourceforge.net/p/lame/svn/HEAD/tarball
+# https://sourceforge.net/code-snapshots/svn/l/la/lame/svn/lame-svn-r6449-trunk.zip
+# And get the exact version with: https://sourceforge.net/projects/lame/best_release.json
+#
+# But for now I just imported everything into OpenStreamCaster's space on GitHub:
+# https://codeload.github.com/openstreamcaster/lame/zip/master
+declare_target("lame",
+               options=("--disable-shared", "--enable-static"),
+               source=Source("https://codeload.github.com/openstreamcaster/lame/zip/master",
+                             "lame-master.zip",
+                             archive_format=ARCHIVE_FORMAT_ZIP),
+               source_dir=("lame-master",),
+               patches=(Patch("install-sh", executable=True),))
+
+# On Windows, there's a huge problem.
+# "Unlike glibc, mingw-w64 does not provide fortified functions at all...
+# "... actually it does now, but its broken as hell :S"
+#
+# MinGW: https://github.com/msys2/MINGW-packages/issues/5803
+# Opus: https://github.com/bincrafters/community/issues/1077
+#
+# Solution:
+# Fortification requires -lssp (or -fstack-protector which adds -lssp implicitly) to work.
+declare_target("opus",
+               options=("--disable-shared", "--enable-static"),
+               source=Source("https://archive.mozilla.org/pub/opus/opus-1.3.1.tar.gz",
+                             "opus-1.3.1.tar.gz",
+                             sha256="65b58e1e25b2a114157014736a3d9dfeaad8d41be1c8179866f144a2fb44ff9d"),
+               source_dir=("opus-1.3.1",),
+               env=lambda: {"LDFLAGS": f"{local.env.get('LDFLAGS', '')} -fstack-protector"}
+               if OS_TYPE == OS_TYPE_WINDOWS else {})
+
+
+def remove_xvidcore_dylib():
+    dylib_file = staged("lib", "libxvidcore.4.dylib")
+    if fex(dylib_file):
+        rm(dylib_file)
+
+
+declare_target("xvidcore", deps=("yasm", "nasm"),
+               options=("--disable-shared", "--enable-static"),
+               source=Source("https://downloads.xvid.com/downloads/xvidcore-1.3.5.tar.gz",
+                             "xvidcore-1.3.5.tar.gz",
+                             sha256="165ba6a2a447a8375f7b06db5a3c91810181f2898166e7c8137401d7fc894cf0"),
+               source_dir=("xvidcore", "build", "generic"),
+               post_install=remove_xvidcore_dylib)
+
+declare_target("x264", deps=("nasm",),
+               options=lambda: ("--enable-static", "--enable-pic") + (
+                   ('CXXFLAGS=\"-fPIC\"',) if OS_TYPE == OS_TYPE_LINUX else ()) + (
+                   optimization_configure_options("x264")),
+               source=Source("https://code.videolan.org/videolan/x264/-/archive/stable/x264-stable.tar.bz2",
+                             "last_x264.tar.bz2"),
+               source_dir=("x264-stable",))
+
+declare_target("libogg",
+               options=("--disable-shared", "--enable-static"),
+               source=Source("http://downloads.xiph.org/releases/ogg/libogg-1.3.3.tar.gz",
+                             "libogg-1.3.3.tar.gz",
+                             sha256="c2e8a485110b97550f453226ec644ebac6cb29d1caef2902c007edab4308d985"),
+               source_dir=("libogg-1.3.3",))
+
+declare_target("libvorbis", deps=("libogg",),
+               options=lambda: ("--disable-shared", "--enable-static", "--disable-oggtest",
+                                f"--with-ogg-libraries={cpp(RELEASE_DIR)}/lib",
+                                f"--with-ogg-includes={cpp(RELEASE_DIR)}/include"),
+               source=Source("http://downloads.xiph.org/releases/vorbis/libvorbis-1.3.6.tar.gz",
+                             "libvorbis-1.3.6.tar.gz",
+                             sha256="6ed40e0241089a42c48604dc00e362beee00036af2d8b3f46338031c9e0351cb"),
+               source_dir=("libvorbis-1.3.6",))
+
+# Always make sure, that you run "./configure" instead of "bash ./configure". Multiple weird errors.
+declare_target("libtheora", deps=("libogg", "libvorbis"),
+               options=lambda: ("--disable-shared", "--enable-static",
+                                "--disable-oggtest", "--disable-vorbistest", "--disable-examples", "--disable-asm",
+                                "--disable-spec",
+                                f"--with-ogg-libraries={RELEASE_DIR}/lib",
+                                f"--with-ogg-includes={RELEASE_DIR}/include/",
+                                f"--with-vorbis-libraries={RELEASE_DIR}/lib",
+                                f"--with-vorbis-includes={RELEASE_DIR}/include/"),
+               source=Source("http://downloads.xiph.org/releases/theora/libtheora-1.1.1.tar.gz",
+                             "libtheora-1.1.1.tar.bz",
+                             sha256="40952956c47811928d1e7922cda3bc1f427eb75680c3c37249c91e949054916b"),
+               source_dir=("libtheora-1.1.1",),
+               patches=(Patch("configure", (("-fforce-addr", ""),)),))
+
+declare_target("pkg-config",
+               options=lambda: ("--silent", "--with-internal-glib", f"--with-pc-path={RELEASE_DIR}/lib/pkgconfig"),
+               relocatable=False,
+               source=Source("http://pkgconfig.freedesktop.org/releases/pkg-config-0.29.2.tar.gz",
+                             "pkg-config-0.29.2.tar.gz",
+                             sha256="6fc69c01688c9458a57eb9a1664c9aba372ccda420a02bf4429fe610e7e7d591"),
+               source_dir=("pkg-config-0.29.2",))
+
+declare_target("cmake", memory=512,
+               source=Source("https://cmake.org/files/v3.15/cmake-3.15.4.tar.gz",
+                             "cmake-3.15.4.tar.gz",
+                             sha256="8a211589ea21374e49b25fc1fc170e2d5c7462b795f1b29c84dd0e984301ed7a"),
+               source_dir=("cmake-3.15.4",),
+               patches=(Patch(pj("Modules", "FindJava.cmake"), remove=True),
+                        Patch(pj("Tests", "CMakeLists.txt"),
+                              (("get_filename_component.JNIPATH", "#get_filename_component(JNIPATH"),))))
+
+declare_target("vid_stab", build_system=BUILD_SYSTEM_CMAKE, deps=("cmake",),
+               options=("-DBUILD_SHARED_LIBS=OFF", "-DUSE_OMP=OFF", "-DENABLE_SHARED:bool=off", "."),
+               source=Source("https://github.com/georgmartius/vid.stab/archive/v1.1.0.tar.gz",
+                             "georgmartius-vid.stab-v1.1.0-0-g60d65da.tar.tgz",
+                             sha256="14d2a053e56edad4f397be0cb3ef8eb1ec3150404ce99a426c4eb641861dc0bb"),
+               source_dir=("vid.stab-1.1.0",))
+
+
+def fix_x265_pc():
+    pc_file = cpp(staged("lib", "pkgconfig", "x265.pc"))
+    with phase("patch"):
+        ((local["sed"]["s/-lx265/-lx265 -lstdc++/g", pc_file]) > f"{pc_file}.tmp")()
+        fg("mv", f"{pc_file}.tmp", pc_file)
+
+
+# x265 is built as a multilib: ffmpeg links only one libx265, so the 10-bit and 12-bit encoders are built
+# as separate static libraries without their own C API and the 8-bit one dispatches to them by bit depth.
+# This is what x265's build/linux/multilib.sh does. High bit depth builds don't depend on each other,
+# so they run in parallel, each with half of the jobs, then the 8-bit library is linked with them
+# and all three are merged into a single libx265.a.
+X265_HIGH_BIT_DEPTHS = (("10bit", "main10", ()),
+                        ("12bit", "main12", ("-DMAIN12=ON",)))
+X265_HIGH_BIT_DEPTH_OPTIONS = ("-DHIGH_BIT_DEPTH=ON", "-DEXPORT_C_API=OFF", "-DENABLE_CLI=OFF")
+
+
+def x265_build_dir(*parts):
+    return pj(WORK_DIR, *TARGET_REGISTRY["x265"].build_dir, *parts)
+
+
+def x265_cmake(build_dir, *opts):
+    mkdir(x265_build_dir(build_dir))
+    with local.cwd(x265_build_dir(build_dir)):
+        cmake(*target_options("x265"), *opts, pj("..", "..", "source"))
+        clean_optimized_tree("x265")
+        make()
+
+
+def build_x265_high_bit_depth(build_dir, jobs, opts):
+    # Runs in a forked process. The log of the parent is still open here, but only the parent may write it
+    global JOBS
+    global TARGET_LOG
+    JOBS = jobs
+    TARGET_LOG = None
+    open_target_log(f"x265.{build_dir}")
+    try:
+        x265_cmake(build_dir, *X265_HIGH_BIT_DEPTH_OPTIONS, *opts)
+    finally:
+        close_target_log()
+        # The parent measures both sub-builds as one phase, they run at the same time
+        PHASE_RECORDS.clear()
+
+
+def build_x265_high_bit_depths():
+    ctx = fork_context()
+    if ctx is None:
+        for build_dir, _, opts in X265_HIGH_BIT_DEPTHS:
+            x265_cmake(build_dir, *X265_HIGH_BIT_DEPTH_OPTIONS, *opts)
+        return
+    jobs = max(1, JOBS // len(X265_HIGH_BIT_DEPTHS))
+    print(f"Building {', '.join(x[0] for x in X265_HIGH_BIT_DEPTHS)} x265 in parallel " +
+          ("on the shared jobserver" if MAKE_JOBSERVER is not None else f"with {jobs} jobs each"))
+    processes = [ctx.Process(target=build_x265_high_bit_depth, args=(build_dir, jobs, opts), name=build_dir)
+                 for build_dir, _, opts in X265_HIGH_BIT_DEPTHS]
+    tokens = b""
+    with phase("make"):
+        try:
+            if MAKE_JOBSERVER is not None:
+                # Every make runs its first job without a token, and the scheduler took just one for x265
+                for _ in processes[1:]:
+                    tokens += os.read(MAKE_JOBSERVER, 1)
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+        finally:
+            if tokens:
+                os.write(MAKE_JOBSERVER, tokens)
+    failed = [x.name for x in processes if x.exitcode != 0]
+    if failed:
+        print(f"Failed to build {', '.join(failed)} x265, see {log_file_name('x265.' + failed[0])}")
+        fail()
 
-    if need_building("xvidcore"):
-        download("https://downloads.xvid.com/downloads/xvidcore-1.3.5.tar.gz",
-                 "xvidcore-1.3.5.tar.gz")
-        with target_cwd("xvidcore", "build", "generic"):
-            configure(RELEASE_DIR, "--disable-shared", "--enable-static")
-            make()
-            install()
-            dylib_file = pj(TARGET_DIR, "lib", "libxvidcore.4.dylib")
-            if fex(dylib_file):
-                rm(dylib_file)
-            mark_as_built("xvidcore")
-
-    if need_building("x264"):
-        download("https://code.videolan.org/videolan/x264/-/archive/stable/x264-stable.tar.bz2",
-                 "last_x264.tar.bz2")
-        with target_cwd("x264-stable"):
-            if OS_TYPE == OS_TYPE_LINUX:
-                configure(RELEASE_DIR, "--enable-static", "--enable-pic", 'CXXFLAGS=\"-fPIC\"')
-            else:
-                configure(RELEASE_DIR, "--enable-static", "--enable-pic")
-            make()
-            install()
-            mark_as_built("x264")
 
-    if need_building("libogg"):
-        download("http://downloads.xiph.org/releases/ogg/libogg-1.3.3.tar.gz",
-                 "libogg-1.3.3.tar.gz")
-        with target_cwd("libogg-1.3.3"):
-            configure(RELEASE_DIR, "--disable-shared", "--enable-static")
-            make()
-            install()
-            mark_as_built("libogg")
-
-    if need_building("libvorbis"):
-        download("http://downloads.xiph.org/releases/vorbis/libvorbis-1.3.6.tar.gz",
-                 "libvorbis-1.3.6.tar.gz")
-        with target_cwd("libvorbis-1.3.6"):
-            configure(RELEASE_DIR, "--disable-shared", "--enable-static", "--disable-oggtest",
-                      f"--with-ogg-libraries={cpp(RELEASE_DIR)}/lib",
-                      f"--with-ogg-includes={cpp(RELEASE_DIR)}/include")
-            make()
-            install()
-            mark_as_built("libvorbis")
-
-    if need_building("libtheora"):
-        download("http://downloads.xiph.org/releases/theora/libtheora-1.1.1.tar.gz",
-                 "libtheora-1.1.1.tar.bz")
-        with target_cwd("libtheora-1.1.1"):
-            print("Removing --fforce-adr from configure")
-            ((local["sed"]["s/-fforce-addr//g", "configure"]) > "configure.patched") & FG
-            fg("chmod", "+x", "configure.patched")
-            fg("mv", "configure.patched", "configure")
-            print("Configure processing done.")
-            # Always make sure, that you run "./configure" instead of "bash ./configure". Multiple weird errors.
-            configure(RELEASE_DIR, "--disable-shared", "--enable-static",
-                      "--disable-oggtest", "--disable-vorbistest", "--disable-examples", "--disable-asm",
-                      "--disable-spec",
-                      f"--with-ogg-libraries={RELEASE_DIR}/lib",
-                      f"--with-ogg-includes={RELEASE_DIR}/include/",
-                      f"--with-vorbis-libraries={RELEASE_DIR}/lib",
-                      f"--with-vorbis-includes={RELEASE_DIR}/include/")
-            make()
-            install()
-            mark_as_built("libtheora")
-
-    if need_building("pkg-config"):
-        download("http://pkgconfig.freedesktop.org/releases/pkg-config-0.29.2.tar.gz",
-                 "pkg-config-0.29.2.tar.gz")
-        with target_cwd("pkg-config-0.29.2"):
-            configure(RELEASE_DIR, "--silent", "--with-internal-glib",
-                      f"--with-pc-path={RELEASE_DIR}/lib/pkgconfig")
-            make()
-            install()
-            mark_as_built("pkg-config")
-
-    if need_building("cmake"):
-        download("https://cmake.org/files/v3.15/cmake-3.15.4.tar.gz",
-                 "cmake-3.15.4.tar.gz")
-        with target_cwd("cmake-3.15.4"):
-            rm("Modules", "FindJava.cmake")
-            (local["perl"][
-                "-p", "-i", "-e", "s/get_filename_component.JNIPATH/#get_filename_component(JNIPATH/g", "Tests/CMakeLists.txt"])()
-            configure(RELEASE_DIR)
-            make()
-            install()
-            mark_as_built("cmake")
+def merge_x265_libraries(libraries):
+    with phase("merge"):
+        if OS_TYPE == OS_TYPE_MAC:
+            if not fg("libtool", "-static", "-o", "libx265.a", *libraries):
+                fail()
+            return
+        # GNU ar can't append archives to an archive from the command line, only with an MRI script on stdin.
+        # Bitcode of optimized builds has to be indexed by the LLVM archiver.
+        ar = shutil.which("llvm-ar") if optimized("x265") else "ar"
+        with open("libx265.mri", "w") as f:
+            f.write("\n".join(("CREATE libx265.a", *(f"ADDLIB {x}" for x in libraries), "SAVE", "END", "")))
+        retcode, stdout, stderr = (local[ar]["-M"] < "libx265.mri").run(retcode=None)
+        if retcode != 0:
+            print(f"Failed to merge x265 libraries")
+            print_lines(*stdout.splitlines(), *stderr.splitlines())
+            fail()
 
-    if need_building("vid_stab"):
-        download("https://github.com/georgmartius/vid.stab/archive/v1.1.0.tar.gz",
-                 "georgmartius-vid.stab-v1.1.0-0-g60d65da.tar.tgz")
-        with target_cwd("vid.stab-1.1.0"):
-            cmake("-DBUILD_SHARED_LIBS=OFF", "-DUSE_OMP=OFF", "-DENABLE_SHARED:bool=off", ".")
-            make()
-            install()
-            mark_as_built("vid_stab")
 
-    if need_building("x265"):
-        download("https://bitbucket.org/multicoreware/x265/downloads/x265_3.2.1.tar.gz",
-                 "x265-3.2.1.tar.gz")
-        with target_cwd("x265_3.2.1", "source"):
-            cmake("-DENABLE_SHARED:bool=off", ".")
-            make()
-            install()
-            ((local["sed"][
-                "s/-lx265/-lx265 -lstdc++/g", f"{cpp(RELEASE_DIR)}/lib/pkgconfig/x265.pc"]) > f"{cpp(RELEASE_DIR)}/lib/pkgconfig/x265.pc.tmp")()
-            fg("mv", f"{cpp(RELEASE_DIR)}/lib/pkgconfig/x265.pc.tmp", f"{cpp(RELEASE_DIR)}/lib/pkgconfig/x265.pc")
-            mark_as_built("x265")
-
-    if need_building("fdk_aac"):
-        download(
-            "https://sourceforge.net/projects/opencore-amr/files/fdk-aac/fdk-aac-2.0.0.tar.gz/download?use_mirror=gigenet",
-            "fdk-aac-2.0.0.tar.gz")
-        with target_cwd("fdk-aac-2.0.0"):
-            configure(RELEASE_DIR, "--disable-shared", "--enable-static")
-            make()
-            install()
-            mark_as_built("fdk_aac")
-
-    if need_building("av1"):
-        download("https://aomedia.googlesource.com/aom/+archive/60a00de69ca79fe5f51dcbf862aaaa8eb50ec344.tar.gz",
-                 "av1.tar.gz", "av1")
-        mkdir(TARGET_DIR, "aom_build")
-        with target_cwd("aom_build"):
-            # TODO: Don't forget about different kinds of cmake (msys/cmake and mingw/cmake)
-            cmake("-DENABLE_TESTS=0", f"{TARGET_DIR}/av1")
+@build_target("x265", deps=("cmake", "nasm"), memory=1024,
+              options=lambda: ("-DENABLE_SHARED:bool=off", *optimization_cmake_options("x265")),
+              source=Source("https://bitbucket.org/multicoreware/x265/downloads/x265_3.2.1.tar.gz",
+                            "x265-3.2.1.tar.gz",
+                            sha256="fb9badcf92364fd3567f8b5aa0e5e952aeea7a39a2b864387cec31e3b58cbbcb"),
+              source_dir=("x265_3.2.1", "source"),
+              build_dir=("x265_3.2.1", "build"),
+              recipe_helpers=(X265_HIGH_BIT_DEPTHS, X265_HIGH_BIT_DEPTH_OPTIONS, x265_build_dir, x265_cmake,
+                              build_x265_high_bit_depth, build_x265_high_bit_depths, merge_x265_libraries,
+                              fix_x265_pc))
+def build_x265():
+    download_source("x265")
+    build_x265_high_bit_depths()
+
+    mkdir(x265_build_dir("8bit"))
+    with local.cwd(x265_build_dir("8bit")):
+        libraries = ["libx265_main.a"]
+        for build_dir, name, _ in X265_HIGH_BIT_DEPTHS:
+            shutil.copy2(x265_build_dir(build_dir, "libx265.a"), f"libx265_{name}.a")
+            libraries.append(f"libx265_{name}.a")
+        # Left from the last build, make would take the merged library for an up to date 8-bit one
+        if fex("libx265_main.a") and fex("libx265.a"):
+            os.remove("libx265.a")
+        cmake(*target_options("x265"),
+              f"-DEXTRA_LIB={';'.join(x[len('lib'):] for x in libraries[1:])}", "-DEXTRA_LINK_FLAGS=-L.",
+              *(f"-DLINKED_{x[0].upper()}=ON" for x in X265_HIGH_BIT_DEPTHS),
+              pj("..", "..", "source"))
+        clean_optimized_tree("x265")
+        make()
+        os.replace("libx265.a", "libx265_main.a")
+        merge_x265_libraries(libraries)
+        install()
+        fix_x265_pc()
+        mark_as_built("x265")
+
+
+declare_target("fdk_aac",
+               options=("--disable-shared", "--enable-static"),
+               source=Source("https://sourceforge.net/projects/opencore-amr/files/fdk-aac/fdk-aac-2.0.0.tar.gz/download?use_mirror=gigenet",
+                             "fdk-aac-2.0.0.tar.gz",
+                             sha256="f7d6e60f978ff1db952f7d5c3e96751816f5aef238ecf1d876972697b85fd96c"),
+               source_dir=("fdk-aac-2.0.0",))
+
+# TODO: Don't forget about different kinds of cmake (msys/cmake and mingw/cmake)
+declare_target("av1", build_system=BUILD_SYSTEM_CMAKE, deps=("cmake", "nasm"), memory=768,
+               options=lambda: ("-DENABLE_TESTS=0", f"{WORK_DIR}/av1"),
+               source=Source("https://aomedia.googlesource.com/aom/+archive/60a00de69ca79fe5f51dcbf862aaaa8eb50ec344.tar.gz",
+                             "av1.tar.gz",
+                             "av1"),
+               source_dir=("av1",),
+               build_dir=("aom_build",))
+
+
+@build_target("zlib",
+              source=Source("https://www.zlib.net/zlib-1.2.11.tar.gz",
+                            "zlib-1.2.11.tar.gz",
+                            sha256="c3e5e9fdd5004dcb542feda5ee4f0ff0744628baf8ed2dd5d66f8ca1197cb1a1"),
+              source_dir=("zlib-1.2.11",))
+def build_zlib():
+    download_source("zlib")
+    with target_cwd(*TARGET_REGISTRY["zlib"].source_dir):
+        if OS_TYPE == OS_TYPE_WINDOWS:
+            # Problem 1:
+            # Please note that
+            # Checking for gcc...
+            # Please use win32/Makefile.gcc instead.
+            # ** ./configure aborting.
+            #
+            # Problem 2:
+            # Making done.
+            # Installing...
+            # INCLUDE_PATH, LIBRARY_PATH, and BINARY_PATH must be specified
+            # make: *** [win32/Makefile.gcc:128: install] Error 1
+
+            # Makefile.gcc prepends DESTDIR to these on install, so they still point to the release prefix
+            with local.env(INCLUDE_PATH=f"{RELEASE_DIR}/include",
+                           LIBRARY_PATH=f"{RELEASE_DIR}/lib",
+                           BINARY_PATH=f"{RELEASE_DIR}/bin"):
+                make("-f", f"./win32/Makefile.gcc")
+                install("-f", f"./win32/Makefile.gcc")
+        else:
+            configure(RELEASE_DIR, *target_options("zlib"))
             make()
             install()
-            mark_as_built("av1")
-
-    if need_building("zlib"):
-        download("https://www.zlib.net/zlib-1.2.11.tar.gz",
-                 "zlib-1.2.11.tar.gz")
-        with target_cwd("zlib-1.2.11"):
-            if OS_TYPE == OS_TYPE_WINDOWS:
-                # Problem 1:
-                # Please note that
-                # Checking for gcc...
-                # Please use win32/Makefile.gcc instead.
-                # ** ./configure aborting.
-                #
-                # Problem 2:
-                # Making done.
-                # Installing...
-                # INCLUDE_PATH, LIBRARY_PATH, and BINARY_PATH must be specified
-                # make: *** [win32/Makefile.gcc:128: install] Error 1
-
-                with local.env(INCLUDE_PATH=f"{RELEASE_DIR}/include",
-                               LIBRARY_PATH=f"{RELEASE_DIR}/lib",
-                               BINARY_PATH=f"{RELEASE_DIR}/bin"):
-                    make("-f", f"./win32/Makefile.gcc")
-                    install("-f", f"./win32/Makefile.gcc")
-            else:
-                configure(RELEASE_DIR)
-                make()
-                install()
-            mark_as_built("zlib")
-
-    if need_building("openssl"):
-        download("https://www.openssl.org/source/openssl-1.1.1d.tar.gz",
-                 "openssl-1.1.1d.tar.gz")
-        with target_cwd("openssl-1.1.1d"):
-            if not fg("bash",
-                      "./config",
-                      f"--prefix={cpp(RELEASE_DIR)}",
-                      f"--openssldir={cpp(RELEASE_DIR)}",
-                      f"--with-zlib-include={cpp(RELEASE_DIR)}/include/",
-                      f"--with-zlib-lib={cpp(RELEASE_DIR)}/lib",
-                      "no-shared",
-                      "zlib"):
+        mark_as_built("zlib")
+
+
+@build_target("openssl", deps=("zlib",), relocatable=False,
+              options=lambda: (f"--prefix={cpp(RELEASE_DIR)}",
+                               f"--openssldir={cpp(RELEASE_DIR)}",
+                               f"--with-zlib-include={cpp(RELEASE_DIR)}/include/",
+                               f"--with-zlib-lib={cpp(RELEASE_DIR)}/lib",
+                               "no-shared",
+                               "zlib"),
+              source=Source("https://www.openssl.org/source/openssl-1.1.1d.tar.gz",
+                            "openssl-1.1.1d.tar.gz",
+                            sha256="1e3a91bc1f9dfce01af26026f856e064eab4c8ee0a8f457b5ae30b40b8b711f2"),
+              source_dir=("openssl-1.1.1d",))
+def build_openssl():
+    download_source("openssl")
+    with target_cwd(*TARGET_REGISTRY["openssl"].source_dir):
+        with phase("configure"):
+            if not fg("bash", "./config", *target_options("openssl")):
                 fail()
-            make()
-            install()
-            mark_as_built("openssl")
-
-    if need_building("sdl"):
-        download(
-            "https://www.libsdl.org/release/SDL2-2.0.12.tar.gz",
-            "SDL2-2.0.12.tar.gz")
-        with target_cwd("SDL2-2.0.12"):
-            configure(RELEASE_DIR, "--disable-shared", "--enable-static")
-            make()
-            install()
-            mark_as_built("sdl")
-
-    if need_building("ffmpeg"):
-        download("https://git.ffmpeg.org/gitweb/ffmpeg.git/snapshot/8e30502abe62f741cfef1e7b75048ae86a99a50f.tar.gz",
-                 "ffmpeg-snapshot.tar.bz2")
-        with target_cwd("ffmpeg-8e30502"):
-            local.env["PKG_CONFIG_PATH"] = f"{cpp(RELEASE_DIR)}/lib/pkgconfig"
-            opts = (RELEASE_DIR,
-                    *FFMPEG_CONFIGURE_EXTENDED_OPTIONS,
-                    # f"--bindirr={cpp(RELEASE_DIR)}/bin"
-                    # f"--libdir={cpp(RELEASE_DIR)}/lib",
-                    f"--pkgconfigdir={cpp(RELEASE_DIR)}/lib/pkgconfig",
-                    "--pkg-config-flags=--static",
-                    f"--extra-cflags=-I{cpp(RELEASE_DIR)}/include",
-                    f"--extra-ldflags=-L{cpp(RELEASE_DIR)}/lib",
-                    f"--extra-ldflags=-fstack-protector",
-                    "--extra-libs=-lm",
-                    "--enable-static",
-                    "--disable-debug",
-                    "--disable-shared",
-                    "--enable-ffplay",
-                    "--disable-doc",
-                    "--enable-gpl",
-                    "--enable-version3",
-                    "--enable-libvpx",
-                    "--enable-libmp3lame",
-                    "--enable-libopus",
-                    "--enable-libtheora",
-                    "--enable-libvorbis",
-                    "--enable-libx264",
-                    "--enable-libx265",
-                    "--enable-runtime-cpudetect",
-                    "--enable-avfilter",
-                    "--enable-libopencore_amrwb",
-                    "--enable-libopencore_amrnb",
-                    "--enable-filters",
-                    "--enable-libvidstab",
-                    "--enable-libaom")
-
-            if not args.slavery_mode:
-                print("Applying free replacements for non-free components")
-                opts = opts + ("--enable-gnutls",)
-
-            if args.slavery_mode:
-                print_p("You are applying dirty non-free attachments. Are you sure you need this?",
-                        "Now you can't distribute this FFmpeg build to anyone, so it's almost useless in real products.",
-                        "You can't sell or give away these files. Consider using --slavery=false")
-                opts = opts + (
-                    "--enable-nonfree",
-                    # Non-free unfortunately
-                    # Should be replaced with gnutls
-                    # http://www.iiwnz.com/compile-ffmpeg-with-rtmps-for-facebook/
-                    "--enable-openssl",
-                    # libfdk_aac is incompatible with the gpl and --enable-nonfree is not specified.
-                    # https://trac.ffmpeg.org/wiki/Encode/AAC
-                    "--enable-libfdk-aac",)
-
-            # Unfortunately even creators of MSYS2 can't build it with --enable-pthreads :(
-            # https://github.com/msys2/MINGW-packages/blob/master/mingw-w64-ffmpeg/PKGBUILD
-            if OS_TYPE != OS_TYPE_WINDOWS:
-                opts = opts + ("--extra-libs=-lpthread",)
-                opts = opts + ("--enable-pthreads",)
-
-            configure(*opts)
-            make()
-            install()
-            mark_as_built("ffmpeg")
+        make()
+        install()
+        mark_as_built("openssl")
+
+
+declare_target("sdl",
+               options=("--disable-shared", "--enable-static"),
+               source=Source("https://www.libsdl.org/release/SDL2-2.0.12.tar.gz",
+                             "SDL2-2.0.12.tar.gz",
+                             sha256="349268f695c02efbc9b9148a70b85e58cefbbf704abd3e91be654db7f1e2c863"),
+               source_dir=("SDL2-2.0.12",))
+
+
+# Build profiles
+# A profile is a manifest of what goes into ffmpeg: targets it's linked with, configure options enabling them,
+# and optionally exact lists of components enabled on top of --disable-everything. Targets that the profile
+# doesn't link with are not built at all. "full" is everything the builder can make.
+Profile = collections.namedtuple("Profile", ["targets", "options", "components"], defaults=(None,))
+
+BUILD_PROFILES = {
+    "full": Profile(
+        targets=FFMPEG_DEPENDENCIES,
+        options=("--enable-ffplay",
+                 "--enable-libvpx",
+                 "--enable-libmp3lame",
+                 "--enable-libopus",
+                 "--enable-libtheora",
+                 "--enable-libvorbis",
+                 "--enable-libx264",
+                 "--enable-libx265",
+                 "--enable-avfilter",
+                 "--enable-libopencore_amrwb",
+                 "--enable-libopencore_amrnb",
+                 "--enable-filters",
+                 "--enable-libvidstab",
+                 "--enable-libaom")),
+    # Ingest RTMP(S)/HLS/MPEG-TS, transcode to an H.264/AAC or Opus ladder, push to RTMP(S)/HLS
+    "live-streaming": Profile(
+        targets=("yasm", "nasm", "x264", "opus", "pkg-config", "zlib", "openssl"),
+        options=("--disable-ffplay",
+                 "--disable-autodetect",
+                 "--enable-zlib",
+                 "--enable-libx264",
+                 "--enable-libopus"),
+        components={
+            "decoder": ("h264", "hevc", "aac", "mp3", "opus", "pcm_s16le"),
+            "encoder": ("libx264", "aac", "libopus"),
+            "parser": ("h264", "hevc", "aac", "opus"),
+            "demuxer": ("flv", "live_flv", "mpegts", "mov", "hls", "wav"),
+            "muxer": ("flv", "mpegts", "hls", "mp4", "segment", "null"),
+            "protocol": ("file", "pipe", "tcp", "udp", "rtmp", "rtmps", "tls", "http", "https", "hls", "crypto"),
+            "bsf": ("h264_mp4toannexb", "hevc_mp4toannexb", "aac_adtstoasc", "extract_extradata"),
+            "filter": ("scale", "fps", "format", "aformat", "aresample", "null", "anull", "split", "asplit",
+                       "setpts", "asetpts", "testsrc2", "sine"),
+            # Generated sources for --benchmark and --optimized training
+            "indev": ("lavfi",),
+        }),
+}
+
+
+def ffmpeg_profile():
+    return BUILD_PROFILES[args.profile]
+
+
+def ffmpeg_dependencies():
+    targets = ffmpeg_profile().targets
+    if args.slavery_mode:
+        return targets
+    return tuple(x for x in targets if x not in NONFREE_TARGETS)
+
+
+def ffmpeg_options():
+    profile = ffmpeg_profile()
+    opts = (*FFMPEG_CONFIGURE_EXTENDED_OPTIONS,
+            # f"--bindirr={cpp(RELEASE_DIR)}/bin"
+            # f"--libdir={cpp(RELEASE_DIR)}/lib",
+            f"--pkgconfigdir={cpp(RELEASE_DIR)}/lib/pkgconfig",
+            "--pkg-config-flags=--static",
+            f"--extra-cflags=-I{cpp(RELEASE_DIR)}/include",
+            f"--extra-ldflags=-L{cpp(RELEASE_DIR)}/lib",
+            f"--extra-ldflags=-fstack-protector",
+            "--extra-libs=-lm",
+            "--enable-static",
+            "--disable-debug",
+            "--disable-shared",
+            "--disable-doc",
+            "--enable-gpl",
+            "--enable-version3",
+            "--enable-runtime-cpudetect",
+            *profile.options)
+
+    if profile.components is not None:
+        opts = opts + ("--disable-everything",)
+        for kind, names in profile.components.items():
+            opts = opts + (f"--enable-{kind}={','.join(names)}",)
+
+    if not args.slavery_mode:
+        opts = opts + ("--enable-gnutls",)
+
+    if args.slavery_mode:
+        opts = opts + ("--enable-nonfree",)
+        if "openssl" in profile.targets:
+            # Non-free unfortunately
+            # Should be replaced with gnutls
+            # http://www.iiwnz.com/compile-ffmpeg-with-rtmps-for-facebook/
+            opts = opts + ("--enable-openssl",)
+        if "fdk_aac" in profile.targets:
+            # libfdk_aac is incompatible with the gpl and --enable-nonfree is not specified.
+            # https://trac.ffmpeg.org/wiki/Encode/AAC
+            opts = opts + ("--enable-libfdk-aac",)
+
+    # Unfortunately even creators of MSYS2 can't build it with --enable-pthreads :(
+    # https://github.com/msys2/MINGW-packages/blob/master/mingw-w64-ffmpeg/PKGBUILD
+    if OS_TYPE != OS_TYPE_WINDOWS:
+        opts = opts + ("--extra-libs=-lpthread",)
+        opts = opts + ("--enable-pthreads",)
+    return opts + optimization_configure_options("ffmpeg") + time_trace_configure_options("ffmpeg")
+
+
+# Patch queue and incremental ffmpeg builds
+# Our own ffmpeg patches live in patches/ffmpeg, applied in the order of its `series` file, or by name without it.
+# The ffmpeg tree is kept between builds together with the list of patches applied to it, so changing the queue
+# only reverts the patches after the first difference and applies the new ones. Configure is skipped when
+# the options, the configure script and the .pc files of dependencies are the same as last time, and make
+# then recompiles only what the patches touched. Static libraries of dependencies aren't known to ffmpeg's
+# Makefile, so when one of them changes the programs are removed to be linked again.
+PATCH_QUEUE_SERIES_FILE = "series"
+PATCH_RECORD_FILE = ".ffmpeg-builder-patches.json"
+PATCH_RECORD_DIR = ".ffmpeg-builder-patches"
+INCREMENTAL_RECORD_FILE = ".ffmpeg-builder-incremental.json"
+FFMPEG_PROGRAMS = ("ffmpeg", "ffprobe", "ffplay")
+
+
+def patch_series(target):
+    queue = pj(CWD, TARGET_REGISTRY[target].patch_queue)
+    if not os.path.isdir(queue):
+        return []
+    series_file = pj(queue, PATCH_QUEUE_SERIES_FILE)
+    if fex(series_file):
+        with open(series_file) as f:
+            names = [x.strip() for x in f if x.strip() and not x.startswith("#")]
+    else:
+        names = sorted(x for x in os.listdir(queue) if x.endswith((".patch", ".diff")))
+    return [[name, file_sha256(pj(queue, name))] for name in names]
 
-    if need_building("ffmpeg-msys2-deps") and (OS_TYPE == OS_TYPE_WINDOWS):
-        download("https://codeload.github.com/olegchir/ffmpeg-windows-deps/zip/master",
-                 "ffmpeg-windows-deps-master.zip", alter_name=None, archive_format=ARCHIVE_FORMAT_ZIP)
-        with target_cwd("ffmpeg-windows-deps-master"):
-            fg("cp", "-f", "./*", f"{RELEASE_DIR}/bin")
-            mark_as_built("ffmpeg-msys2-deps")
+
+def tree_extracted_at(target):
+    # Changes every time the archive is extracted over the tree, which brings back pristine sources
+    return os.path.getmtime(extraction_stamp_file_name(TARGET_REGISTRY[target].source))
+
+
+def read_record(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_record(path, record):
+    with open(path, "w") as f:
+        json.dump(record, f, indent=2)
+
+
+def apply_patch_queue(target):
+    series = patch_series(target)
+    record = read_record(PATCH_RECORD_FILE)
+    extracted_at = tree_extracted_at(target)
+    applied = record.get("applied", []) if record.get("extracted_at") == extracted_at else []
+    common = 0
+    while common < min(len(applied), len(series)) and applied[common] == series[common]:
+        common += 1
+    if common == len(applied) == len(series):
+        if series:
+            print(f"Patch queue is already applied: {', '.join(x[0] for x in series)}")
+        return
+    require_commands("patch")
+
+    def save():
+        write_record(PATCH_RECORD_FILE, {"extracted_at": extracted_at, "applied": applied})
+
+    with phase("patch"):
+        os.makedirs(PATCH_RECORD_DIR, exist_ok=True)
+        # The applied version of a patch is kept in the tree, the queue may have a newer one by now
+        while len(applied) > common:
+            name = applied[-1][0]
+            print(f"Reverting patch {name}")
+            if not fg("patch", "-p1", "-R", "--batch", "-i", pj(PATCH_RECORD_DIR, name)):
+                print_p(f"Patch {name} can't be reverted, the tree was changed by hand?",
+                        f"Remove {local.cwd} to start from a clean snapshot")
+                fail()
+            os.remove(pj(PATCH_RECORD_DIR, name))
+            applied.pop()
+            save()
+        for name, sha256 in series[common:]:
+            path = pj(CWD, TARGET_REGISTRY[target].patch_queue, name)
+            print(f"Applying patch {name}")
+            # A dry run first, so a patch that doesn't apply leaves no half-patched files
+            if not fg("patch", "-p1", "--forward", "--batch", "--dry-run", "-i", path) or \
+                    not fg("patch", "-p1", "--forward", "--batch", "-i", path):
+                print(f"Patch {name} doesn't apply to {local.cwd}")
+                fail()
+            shutil.copy2(path, pj(PATCH_RECORD_DIR, name))
+            applied.append([name, sha256])
+            save()
+
+
+def configure_inputs(target, options):
+    pc_dir = pj(RELEASE_DIR, "lib", "pkgconfig")
+    pc_files = sorted(x for x in os.listdir(pc_dir) if x.endswith(".pc")) if fex(pc_dir) else []
+    return {"options": list(options),
+            "configure": file_sha256("configure"),
+            # The recipe and its helpers decide when configure may be skipped, a change in them has to rerun it
+            "recipe": recipe_hash(target),
+            "environment": {var: local.env.get(var) for var in TOOLCHAIN_ENV_VARS},
+            "pc": {x: file_sha256(pj(pc_dir, x)) for x in pc_files}}
+
+
+def linked_libraries():
+    lib_dir = pj(RELEASE_DIR, "lib")
+    if not fex(lib_dir):
+        return {}
+    return {x: file_identity(pj(lib_dir, x)) for x in sorted(os.listdir(lib_dir)) if x.endswith((".a", ".lib"))}
+
+
+def configure_incrementally(target, prefix, *opts):
+    record = read_record(INCREMENTAL_RECORD_FILE)
+    inputs = configure_inputs(target, opts)
+    if record.get("extracted_at") != tree_extracted_at(target):
+        # Extracted files get their old mtimes back, so objects of another snapshot would look up to date
+        if fex(pj("ffbuild", "config.mak")):
+            with phase("clean"):
+                fg("make", "distclean")
+        record = {}
+    if record.get("configure") == inputs and fex(pj("ffbuild", "config.mak")):
+        print("Configure skipped: options, configure script and dependencies didn't change")
+    else:
+        record.pop("configure", None)
+        write_record(INCREMENTAL_RECORD_FILE, record)
+        configure(prefix, *opts)
+        record = {"extracted_at": tree_extracted_at(target), "configure": inputs}
+        write_record(INCREMENTAL_RECORD_FILE, record)
+
+    libraries = linked_libraries()
+    if record.get("libraries") != libraries:
+        exe = ".exe" if OS_TYPE == OS_TYPE_WINDOWS else ""
+        for name in FFMPEG_PROGRAMS:
+            for program in (f"{name}{exe}", f"{name}_g{exe}"):
+                if fex(program):
+                    os.remove(program)
+    record["libraries"] = libraries
+    return record
+
+
+@build_target("ffmpeg", deps=ffmpeg_dependencies, memory=1024, relocatable=False,
+              options=ffmpeg_options,
+              source=Source("https://git.ffmpeg.org/gitweb/ffmpeg.git/snapshot/8e30502abe62f741cfef1e7b75048ae86a99a50f.tar.gz",
+                            "ffmpeg-snapshot.tar.bz2"),
+              source_dir=("ffmpeg-8e30502",),
+              patch_queue=pj("patches", "ffmpeg"),
+              recipe_helpers=(PATCH_QUEUE_SERIES_FILE, PATCH_RECORD_FILE, PATCH_RECORD_DIR, INCREMENTAL_RECORD_FILE,
+                              FFMPEG_PROGRAMS, patch_series, tree_extracted_at, read_record, write_record,
+                              apply_patch_queue, configure_inputs, linked_libraries, configure_incrementally))
+def build_ffmpeg():
+    download_source("ffmpeg")
+    with target_cwd(*TARGET_REGISTRY["ffmpeg"].source_dir):
+        local.env["PKG_CONFIG_PATH"] = f"{cpp(RELEASE_DIR)}/lib/pkgconfig"
+        if not args.slavery_mode:
+            print("Applying free replacements for non-free components")
+        else:
+            print_p("You are applying dirty non-free attachments. Are you sure you need this?",
+                    "Now you can't distribute this FFmpeg build to anyone, so it's almost useless in real products.",
+                    "You can't sell or give away these files. Consider using --slavery=false")
+
+        apply_patch_queue("ffmpeg")
+        record = configure_incrementally("ffmpeg", RELEASE_DIR, *target_options("ffmpeg"))
+        clean_optimized_tree("ffmpeg")
+        make()
+        # Libraries are remembered only when the programs were linked with them
+        write_record(INCREMENTAL_RECORD_FILE, record)
+        install()
+        mark_as_built("ffmpeg")
+
+
+@build_target("ffmpeg-msys2-deps", deps=("ffmpeg",), only_on=(OS_TYPE_WINDOWS,),
+              source=Source("https://codeload.github.com/olegchir/ffmpeg-windows-deps/zip/master",
+                            "ffmpeg-windows-deps-master.zip",
+                            archive_format=ARCHIVE_FORMAT_ZIP),
+              source_dir=("ffmpeg-windows-deps-master",))
+def build_ffmpeg_msys2_deps():
+    download_source("ffmpeg-msys2-deps")
+    with target_cwd(*TARGET_REGISTRY["ffmpeg-msys2-deps"].source_dir):
+        mkdir(staged("bin"))
+        fg("cp", "-f", "./*", staged("bin"))
+        mark_as_built("ffmpeg-msys2-deps")
+
+
+# Benchmark
+# Encodes generated lavfi sources with every enabled encoder and records throughput, so results of two builds
+# can be compared and a slower snapshot or flag change is caught before it ships.
+BENCHMARK_VIDEO_SOURCE = "testsrc2=size=1280x720:rate=30"
+BENCHMARK_AUDIO_SOURCE = "sine=frequency=1000:sample_rate=48000"
+BENCHMARK_ENCODERS = (
+    ("libx264", "video", (("ultrafast", ("-preset", "ultrafast")),
+                          ("medium", ("-preset", "medium")))),
+    ("libx265", "video", (("ultrafast", ("-preset", "ultrafast")),
+                          ("medium", ("-preset", "medium")))),
+    ("libvpx", "video", (("realtime", ("-deadline", "realtime", "-cpu-used", "8")),
+                         ("good", ("-deadline", "good", "-cpu-used", "2")))),
+    ("libvpx-vp9", "video", (("realtime", ("-deadline", "realtime", "-cpu-used", "8", "-row-mt", "1")),
+                             ("good", ("-deadline", "good", "-cpu-used", "4", "-row-mt", "1")))),
+    ("libaom-av1", "video", (("cpu-used-8", ("-cpu-used", "8", "-row-mt", "1")),
+                             ("cpu-used-6", ("-cpu-used", "6", "-row-mt", "1")))),
+    ("libopus", "audio", (("128k", ("-b:a", "128k")),)),
+    ("libmp3lame", "audio", (("128k", ("-b:a", "128k")),)),
+    ("libvorbis", "audio", (("q4", ("-q:a", "4")),)),
+    # Only present in --slavery builds
+    ("libfdk_aac", "audio", (("128k", ("-b:a", "128k")),)),
+)
+
+
+def ffmpeg_binary():
+    return pj(RELEASE_BIN_DIR, "ffmpeg.exe" if OS_TYPE == OS_TYPE_WINDOWS else "ffmpeg")
+
+
+def enabled_encoders(ffmpeg):
+    result = local[ffmpeg].run(("-hide_banner", "-encoders"), retcode=None)
+    encoders = set()
+    for line in result[1].splitlines():
+        # " V....D libx264              libx264 H.264 / AVC / MPEG-4 AVC / MPEG-4 part 10 (codec h264)"
+        parts = line.split()
+        if len(parts) >= 2 and len(parts[0]) == 6 and parts[0][0] in "VAS":
+            encoders.add(parts[1])
+    return encoders
+
+
+def run_benchmark_case(ffmpeg, encoder, kind, preset_args):
+    source = BENCHMARK_VIDEO_SOURCE if kind == "video" else BENCHMARK_AUDIO_SOURCE
+    cmd = ("-hide_banner", "-nostdin", "-nostats", "-benchmark", "-progress", "pipe:1",
+           "-f", "lavfi", "-i", source, "-t", str(args.benchmark_duration),
+           "-c:v" if kind == "video" else "-c:a", encoder, *preset_args, "-f", "null", "-")
+    started = time.time()
+    retcode, stdout, stderr = local[ffmpeg].run(cmd, retcode=None)
+    wall = time.time() - started
+    if retcode != 0:
+        print(f"Benchmark of {encoder} failed with exit code {retcode}")
+        print(os.linesep.join(stderr.splitlines()[-10:]))
+        return None
+
+    progress = {}
+    for line in stdout.splitlines():
+        if "=" in line:
+            key, value = line.split("=", 1)
+            progress[key.strip()] = value.strip()
+    result = {"wall": wall, "fps": None, "speed": None}
+    try:
+        if kind == "video":
+            result["fps"] = float(progress.get("fps", "nan"))
+        result["speed"] = float(progress.get("speed", "nan").rstrip("x"))
+    except ValueError:
+        pass
+    bench = re.search(r"bench: utime=([\d.]+)s stime=([\d.]+)s rtime=([\d.]+)s", stderr)
+    if bench:
+        result["cpu"] = float(bench.group(1)) + float(bench.group(2))
+        result["rtime"] = float(bench.group(3))
+    maxrss = re.search(r"bench: maxrss=(\d+)(?:kB|KiB)", stderr)
+    if maxrss:
+        result["peak_rss_kb"] = int(maxrss.group(1))
+    return result
+
+
+def median(values):
+    values = sorted(x for x in values if x is not None)
+    if not values:
+        return None
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+
+def summarize_runs(runs):
+    summary = {}
+    for metric in ("fps", "speed", "cpu", "rtime", "wall"):
+        summary[metric] = median(x.get(metric) for x in runs)
+    rss = [x["peak_rss_kb"] for x in runs if "peak_rss_kb" in x]
+    summary["peak_rss_kb"] = max(rss) if rss else None
+    summary["runs"] = runs
+    return summary
+
+
+def compare_benchmarks(old_file, results):
+    with open(old_file) as f:
+        old_results = json.load(f)["results"]
+    print_header(f"Comparison with {old_file} (speed factor, old -> new):")
+    regressions = []
+    for case, new in results.items():
+        old = old_results.get(case)
+        if old is None or not old.get("speed") or not new.get("speed"):
+            print(f"{case:>28}: no comparable result")
+            continue
+        change = 100 * (new["speed"] - old["speed"]) / old["speed"]
+        mark = ""
+        if change < -args.benchmark_threshold:
+            mark = "  <-- REGRESSION"
+            regressions.append(case)
+        print(f"{case:>28}: {old['speed']:.3f}x -> {new['speed']:.3f}x ({change:+.1f}%){mark}")
+    print_block(f"Regressions over {args.benchmark_threshold}%: {', '.join(regressions) if regressions else 'none'}")
+    return regressions
+
+
+def run_benchmarks():
+    ffmpeg = ffmpeg_binary()
+    if not fex(ffmpeg):
+        print(f"No ffmpeg binary to benchmark: {ffmpeg}")
+        fail()
+    if args.benchmark_compare is not None and not fex(args.benchmark_compare):
+        print(f"No benchmark results to compare with: {args.benchmark_compare}")
+        fail()
+    print_header(f"Benchmarking {ffmpeg}")
+    encoders = enabled_encoders(ffmpeg)
+    results = {}
+    for encoder, kind, presets in BENCHMARK_ENCODERS:
+        if encoder not in encoders:
+            print(f"Encoder {encoder} is not enabled in this build, skipping")
+            continue
+        for preset_name, preset_args in presets:
+            runs = []
+            for x in range(max(1, args.benchmark_runs)):
+                run = run_benchmark_case(ffmpeg, encoder, kind, preset_args)
+                if run is not None:
+                    runs.append(run)
+            if not runs:
+                continue
+            case = f"{encoder}/{preset_name}"
+            results[case] = summarize_runs(runs)
+            summary = results[case]
+            print(f"{case:>28}: fps {summary['fps'] if summary['fps'] is not None else '-'}, "
+                  f"speed {summary['speed']}x, cpu {summary['cpu']}s, peak rss {summary['peak_rss_kb']} kB")
+
+    ffmpeg_stamp = read_build_stamp("ffmpeg")
+    version = local[ffmpeg].run(("-hide_banner", "-version"), retcode=None)[1].splitlines()
+    report = {
+        "ffmpeg": ffmpeg,
+        "version": version[0] if version else None,
+        "build_key": ffmpeg_stamp["key"] if ffmpeg_stamp is not None else None,
+        "host": platform.node(),
+        "os": OS_TYPE,
+        "cpus": os.cpu_count(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "duration": args.benchmark_duration,
+        "video_source": BENCHMARK_VIDEO_SOURCE,
+        "audio_source": BENCHMARK_AUDIO_SOURCE,
+        "results": results,
+    }
+    with open(args.benchmark_output, "w") as f:
+        json.dump(report, f, indent=2)
+    print_block(f"Benchmark results: {args.benchmark_output}")
+
+    if args.benchmark_compare is not None and compare_benchmarks(args.benchmark_compare, results):
+        fail()
+
+
+def build_all():
+    print_header("Building process started")
+    mkdirs(TARGET_DIR, RELEASE_DIR, DOWNLOAD_CACHE_DIR)
+    push_path(RELEASE_BIN_DIR)
+    require_commands("make", "g++")
+    set_jobs_num()
+    setup_compiler_cache()
+    reset_reports()
+
+    try:
+        built = build_optimized() if args.optimized_mode else run_scheduler()
+    finally:
+        write_build_report()
+        write_time_trace_report()
+    print_compiler_cache_report(built)
+    if CACHE_SIZE_LIMIT is not None:
+        print_header("Trimming caches")
+        collect_garbage(remove_unused=False)
 
     print_block()
     print_block(f"Finished: {cpp(RELEASE_DIR)}/bin/ffmpeg",
@@ -824,24 +4121,130 @@ def build_all():
                 f"export PATH={cpp(RELEASE_DIR)}/bin:$PATH")
     print_block("And finally. Don't trust the build. Anything in the script output may be a lie.",
                 "Always check what you're doing and run test suite.",
+                "Encoder throughput can be measured with --benchmark.",
                 "If you don't have one, ask for professional help.")
 
 
+def fetch_all():
+    print_header("Fetching process started")
+    mkdirs(TARGET_DIR, DOWNLOAD_CACHE_DIR)
+    run_scheduler(fetch_only=True)
+
+
+# Matrix builds
+# Every variant is built by a separate run of this script with its own targets and release directories
+# (matrix/<variant>/), so variants never see each other's libraries. Cache keys don't depend on these directories
+# (except for targets that aren't relocatable), so a target with the same inputs in several variants
+# (yasm, cmake, libogg, ...) gets the same key everywhere.
+# Variants share an artifact cache: the first variant builds and exports such a target, the next ones only
+# restore and relocate it. Only targets that really differ (ffmpeg, openssl, fdk_aac) are built per variant.
+MATRIX_ARTIFACT_DIR = pj(MATRIX_DIR, "artifacts")
+MATRIX_MODES = ("freedom", "slavery")
+# Options that are set per variant and must not be passed through
+MATRIX_VALUE_OPTIONS = ("--matrix", "--variant", "--profile")
+MATRIX_FLAG_OPTIONS = ("--slavery", "--freedom")
+
+
+def parse_matrix(value):
+    variants = []
+    for spec in split_targets(value):
+        mode, _, profile = spec.partition("/")
+        profile = profile or args.profile
+        if mode not in MATRIX_MODES or profile not in BUILD_PROFILES:
+            print(f"Unknown matrix variant: {spec}, expected freedom|slavery[/{'|'.join(BUILD_PROFILES)}]")
+            fail()
+        name = f"{mode}-{profile}"
+        if name not in [x[0] for x in variants]:
+            variants.append((name, mode, profile))
+    return variants
+
+
+def variant_argv(name, mode, profile):
+    result = []
+    skip_value = False
+    for arg in sys.argv[1:]:
+        if skip_value:
+            skip_value = False
+            continue
+        option = arg.split("=", 1)[0]
+        if option in MATRIX_VALUE_OPTIONS:
+            skip_value = "=" not in arg
+            continue
+        if option in MATRIX_FLAG_OPTIONS:
+            continue
+        result.append(arg)
+    result += ["--variant", name, f"--{mode}", "--profile", profile]
+    if args.artifact_cache is None:
+        result += ["--artifact-cache", MATRIX_ARTIFACT_DIR]
+    return result
+
+
+def build_matrix():
+    variants = parse_matrix(args.matrix)
+    if args.artifact_cache is not None and not args.artifact_upload:
+        print("With --no-artifact-upload variants can't share targets that aren't in the cache yet")
+    print_header("Matrix variants:")
+    print_block(*(f"{name}: {pj(MATRIX_DIR, name, 'release')}" for name, _, _ in variants))
+
+    results = []
+    for name, mode, profile in variants:
+        print_header(f"Variant {name}")
+        started = time.monotonic()
+        # A plain child process: output goes straight to our terminal, which works on Windows as well
+        retcode = subprocess.call([sys.executable, os.path.abspath(__file__), *variant_argv(name, mode, profile)])
+        results.append((name, retcode, time.monotonic() - started))
+
+    print_header("Matrix results:")
+    print_block(*(f"{name:>30}: {'ok' if retcode == 0 else f'failed ({retcode})'}, {format_duration(wall)}"
+                  for name, retcode, wall in results))
+    if any(retcode != 0 for _, retcode, _ in results):
+        fail()
+
+
 def main():
+    if args.worker_mode or args.worker_listen is not None:
+        run_worker()
+        return
+
+    if args.matrix is not None and args.variant is None:
+        build_matrix()
+        return
+
     if args.slavery_mode:
         print_block("Hello, slave, how are you?")
     else:
         print_block("Building FFmpeg, free as in freedom!")
 
+    select_targets()
     print_header("Processing targets:")
     print_block(f"{TARGETS}")
 
+    if args.rdeps is not None:
+        names = [x for x in split_targets(args.rdeps) if x in TARGET_REGISTRY]
+        dependents = [x for x in reverse_dependencies(names) if x not in names]
+        print_header(f"Targets depending on {', '.join(names)}:")
+        print_block(", ".join(dependents) if dependents else "nothing")
+
+    if args.plan_mode:
+        print_plan()
+        return
+
     if args.clean_mode:
         clean_all()
 
+    if args.gc_mode:
+        print_header("Collecting garbage")
+        collect_garbage(remove_unused=True)
+
+    if args.fetch_mode:
+        fetch_all()
+
     if args.build_mode:
         build_all()
 
+    if args.benchmark_mode:
+        run_benchmarks()
+
     print("OpenStreamCaster's FFmpeg-builder finished its work. And you?")
 
 